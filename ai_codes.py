@@ -0,0 +1,187 @@
+# ===============================================
+# ai_codes.py - Подбор кодов УКТЗЕД по описанию товара
+# 1) постоянный кэш ответов по нормализованному описанию (TTL, ограничение размера);
+# 2) локальный поиск по уже встречавшимся в базе описаниям (opis_tovaru) -
+#    кандидаты показываются до ответа модели, а при сильном совпадении модель не вызывается;
+# 3) модель (Gemini) - через подменяемый клиент, чтобы сервис можно было проверять с заглушкой.
+# ===============================================
+
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+PROMPT_TEMPLATE = """
+    Ти експерт з митної класифікації та українських кодів УКТЗЕД. Проаналізуй опис товару та надай список потенційних кодів УКТЗЕД.
+    Включи коди різної довжини (наприклад, 4, 6, 10 знаків). Твоя відповідь МАЄ БУТИ ТІЛЬКИ у форматі JSON, що є єдиним списком рядків.
+    Приклад правильної відповіді: ["8517", "851712", "8517120000"] Не додавай жодних описів, пояснень чи іншого тексту поза межами JSON-масиву.
+    ОПИС ТОВАРУ: "{description}"
+    """
+
+# matched - сколько слов запроса нашлось в описании
+Candidate = namedtuple('Candidate', ['code', 'score', 'declarations', 'description', 'matched'])
+Suggestion = namedtuple('Suggestion', ['codes', 'source', 'candidates'])
+
+class UnexpectedModelResponse(ValueError):
+    pass
+
+# --- НОРМАЛИЗАЦИЯ ТЕКСТА ---
+
+_NON_WORD_RE = re.compile(r"[^\w]+")
+# Грубый стемминг для украинских/русских окончаний: длинные слова обрезаются до 6 символов
+STEM_LENGTH = 6
+
+def normalize_description(text):
+    return " ".join(_NON_WORD_RE.sub(" ", (text or "").lower().replace("_", " ")).split())
+
+def tokenize(text):
+    return [t[:STEM_LENGTH] for t in normalize_description(text).split() if len(t) >= 3 or t.isdigit()]
+
+# --- ЛОКАЛЬНЫЙ ИНДЕКС ОПИСАНИЙ ---
+
+def description_index_query(dialect, limit=200000):
+    # Самые частые пары (описание, код) - этого хватает, чтобы покрыть повторяющиеся запросы аналитиков
+    query = f"""
+    SELECT opis_tovaru, kod_uktzed, COUNT(*) AS declarations
+    FROM {dialect.table()} WHERE opis_tovaru IS NOT NULL AND kod_uktzed IS NOT NULL
+    GROUP BY opis_tovaru, kod_uktzed ORDER BY declarations DESC LIMIT {int(limit)}
+    """
+    return query, []
+
+class DescriptionIndex:
+    # Инвертированный индекс токен -> описания; оценка - доля IDF-веса токенов запроса,
+    # найденных в описании (1.0 - все слова запроса встречаются в описании из базы)
+    def __init__(self, rows, max_df_ratio=0.2):
+        self.docs = []; postings = defaultdict(list)
+        for description, code, declarations in rows:
+            doc_id = len(self.docs); self.docs.append((str(code), int(declarations), description))
+            for token in set(tokenize(description)): postings[token].append(doc_id)
+        total = max(len(self.docs), 1)
+        # Слишком частые токены ("для", "виріб") почти ничего не различают - не индексируем их
+        self.postings = {t: ids for t, ids in postings.items() if len(ids) <= max(max_df_ratio * total, 100)}
+        self.idf = {t: math.log(1 + total / len(ids)) for t, ids in self.postings.items()}
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(df[['opis_tovaru', 'kod_uktzed', 'declarations']].itertuples(index=False, name=None))
+
+    def __len__(self):
+        return len(self.docs)
+
+    def match(self, description, top_k=10):
+        tokens = [t for t in set(tokenize(description)) if t in self.idf]
+        if not tokens: return []
+        query_weight = sum(self.idf[t] for t in tokens)
+        doc_scores = defaultdict(float); doc_hits = defaultdict(int)
+        for token in tokens:
+            for doc_id in self.postings[token]: doc_scores[doc_id] += self.idf[token]; doc_hits[doc_id] += 1
+        best = {}  # код -> [score, declarations, description, matched]
+        for doc_id, weight in doc_scores.items():
+            code, declarations, text = self.docs[doc_id]; score = weight / query_weight
+            current = best.get(code)
+            if current is None or score > current[0] + 1e-9: best[code] = [score, declarations, text, doc_hits[doc_id]]
+            elif abs(score - current[0]) <= 1e-9: current[1] += declarations
+        ranked = sorted(best.items(), key=lambda item: (-item[1][0], -item[1][1], item[0]))[:top_k]
+        return [Candidate(code, round(score, 4), declarations, text, matched) for code, (score, declarations, text, matched) in ranked]
+
+# --- ПОСТОЯННЫЙ КЭШ ОТВЕТОВ ---
+
+class SuggestionCache:
+    def __init__(self, path, ttl=30 * 86400, max_entries=5000, clock=time.time):
+        self.path = path; self.ttl = ttl; self.max_entries = max_entries; self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = self._load()  # нормализованное описание -> {'codes': [...], 'source': ..., 'stored_at': ...}
+
+    def _load(self):
+        if not self.path: return {}
+        try:
+            with open(self.path, encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_locked(self):
+        if not self.path: return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(self._entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get(self, description):
+        key = normalize_description(description)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            if self.clock() - entry['stored_at'] > self.ttl:
+                del self._entries[key]; return None
+            return entry
+
+    def put(self, description, codes, source):
+        key = normalize_description(description)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = {'codes': list(codes), 'source': source, 'stored_at': self.clock()}
+            # dict сохраняет порядок вставки - первыми вытесняются самые старые ответы
+            while len(self._entries) > self.max_entries: del self._entries[next(iter(self._entries))]
+            self._save_locked()
+
+    def __len__(self):
+        return len(self._entries)
+
+# --- МОДЕЛЬ ---
+
+class GeminiModelClient:
+    def __init__(self, model_name='models/gemini-pro-latest'):
+        self.model_name = model_name
+
+    def generate(self, prompt):
+        import google.generativeai as genai
+        model = genai.GenerativeModel(self.model_name)
+        generation_config = genai.types.GenerationConfig(response_mime_type="application/json")
+        return model.generate_content(prompt, generation_config=generation_config).text
+
+def parse_model_codes(text):
+    cleaned_text = text.strip().replace("```json", "").replace("```", "").strip()
+    response_json = json.loads(cleaned_text)
+    if isinstance(response_json, list) and all(isinstance(i, str) for i in response_json): return response_json
+    raise UnexpectedModelResponse("AI повернув дані у неочікуваному форматі.")
+
+# --- СЕРВИС ---
+
+class CodeSuggestionService:
+    # model_client - любой объект с методом generate(prompt) -> str (в тестах - заглушка);
+    # None - модель недоступна, работают только кэш и локальный поиск.
+    def __init__(self, model_client=None, cache=None, index=None, strong_score=0.9, min_declarations=3, min_matched=2, top_k=10):
+        self.model_client = model_client; self.cache = cache; self.index = index
+        self.strong_score = strong_score; self.min_declarations = min_declarations
+        self.min_matched = min_matched; self.top_k = top_k
+
+    def local_candidates(self, description):
+        return self.index.match(description, top_k=self.top_k) if self.index is not None else []
+
+    def strong_codes(self, candidates):
+        # Полное покрытие запроса ещё не сильное совпадение: запрос из одного слова покрыт любым описанием
+        # с этим словом. Нужны несколько совпавших слов, достаточно деклараций у лучшего кандидата и
+        # согласие всех кандидатов с полным покрытием в товарной позиции (4 знака). Иначе - [].
+        strong = [c for c in candidates if c.score >= self.strong_score and c.matched >= self.min_matched]
+        if not strong or strong[0] is not candidates[0] or strong[0].declarations < self.min_declarations: return []
+        if len({c.code[:4] for c in strong}) > 1: return []
+        return [c.code for c in strong]
+
+    def suggest(self, description, on_candidates=None):
+        # on_candidates(candidates) вызывается до обращения к модели - интерфейс может сразу показать кандидатов
+        cached = self.cache.get(description) if self.cache is not None else None
+        if cached is not None: return Suggestion(cached['codes'], 'cache', [])
+        candidates = self.local_candidates(description)
+        # Локальный ответ не кэшируется: индекс и так отвечает мгновенно, а запись под тем же ключом
+        # на весь TTL подменила бы ответ модели, если данные в базе изменятся
+        codes = self.strong_codes(candidates)
+        if codes: return Suggestion(codes, 'local', candidates)
+        if candidates and on_candidates is not None: on_candidates(candidates)
+        if self.model_client is None:
+            return Suggestion([c.code for c in candidates], 'local', candidates)
+        codes = parse_model_codes(self.model_client.generate(PROMPT_TEMPLATE.format(description=description)))
+        if self.cache is not None and codes: self.cache.put(description, codes, 'model')
+        return Suggestion(codes, 'model', candidates)
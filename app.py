@@ -6,19 +6,73 @@
 import os
 import streamlit as st
 from google.cloud import bigquery
-from google.cloud.bigquery import QueryJobConfig, ArrayQueryParameter, ScalarQueryParameter
 import pandas as pd
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
-import json
 import re
-from io import BytesIO
+import time
+import uuid
+from query_backend import create_backend
+from functools import partial
+from export import EXPORT_FORMATS, cleanup_exports, export_to_tempfile, read_export_file
+from query_builder import DISPLAY_COLUMNS, COLUMN_LABELS, COMPANY_LABELS, COMPANY_SORTS, process_text_input, search_query, count_query, company_query, company_count_query, positions_query, code_validation_query
+from filter_catalog import refresh_catalog
+from query_cache import QueryResultCache, cache_key
+from code_index import CodeIndex, code_index_query
+from company_index import CompanyIndex, company_index_query
+from query_jobs import JobCancelled, QueryExecutor, checked, wait_any
+from query_metrics import QueryLog, STATS_LABELS, format_bytes, frame_stats, measure_query, stats_frame, summarize_stats
+from result_store import ResultPage, ResultStore, compact_frame, result_id
+from rollups import METRIC_COLUMNS, METRIC_LABELS, refresh_rollup
+from ai_codes import CodeSuggestionService, DescriptionIndex, GeminiModelClient, SuggestionCache, UnexpectedModelResponse, description_index_query
 
 # --- КОНФИГУРАЦИЯ ---
 APP_VERSION = "Версия 22.0"
 st.set_page_config(page_title="Аналітика Митних Даних", layout="wide")
 PROJECT_ID = "ua-customs-analytics"
-TABLE_ID = f"{PROJECT_ID}.ua_customs_data.declarations"
+# USE_TYPED_TABLE=1 - запросы идут к типизированной партиционированной копии (см. typed_table.py)
+USE_TYPED_TABLE = os.environ.get("USE_TYPED_TABLE", "0") == "1"
+TABLE_ID = f"{PROJECT_ID}.ua_customs_data.{'declarations_typed' if USE_TYPED_TABLE else 'declarations'}"
+# Бэкенд запросов: 'bigquery' (по умолчанию) или 'duckdb' - локальная Parquet-копия таблицы declarations
+QUERY_BACKEND = os.environ.get("QUERY_BACKEND", "bigquery")
+LOCAL_PARQUET_PATH = os.environ.get("LOCAL_PARQUET_PATH", os.path.join("data", "declarations"))
+# Каталог значений фильтров хранится на диске (на Cloud Run - смонтированный том), чтобы холодный старт не сканировал таблицу
+FILTER_CATALOG_PATH = os.environ.get("FILTER_CATALOG_PATH", os.path.join("data", f"filter_catalog_{QUERY_BACKEND}.json"))
+CATALOG_MAX_AGE = int(os.environ.get("CATALOG_MAX_AGE", 3600))
+# Свёртки для аналитики трендов (rollups.py): файл на диске и период догрузки новых месяцев
+ROLLUP_PATH = os.environ.get("ROLLUP_PATH", os.path.join("data", f"rollup_{QUERY_BACKEND}.parquet"))
+ROLLUP_MAX_AGE = int(os.environ.get("ROLLUP_MAX_AGE", CATALOG_MAX_AGE))
+# Общий кэш результатов запросов: бюджет памяти и срок жизни записи
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+QUERY_CACHE_TTL = int(os.environ.get("QUERY_CACHE_TTL", 3600))
+# Постоянный кэш подсказок AI по нормализованному описанию товара
+AI_SUGGESTION_CACHE_PATH = os.environ.get("AI_SUGGESTION_CACHE_PATH", os.path.join("data", "ai_suggestions.json"))
+AI_SUGGESTION_CACHE_TTL = int(os.environ.get("AI_SUGGESTION_CACHE_TTL", 30 * 86400))
+AI_SUGGESTION_CACHE_MAX_ENTRIES = int(os.environ.get("AI_SUGGESTION_CACHE_MAX_ENTRIES", 5000))
+# Больше компаний, чем это, в IN-список не передаём - остаётся фильтр LIKE по названию
+COMPANY_MATCH_MAX_CODES = int(os.environ.get("COMPANY_MATCH_MAX_CODES", 10000))
+COMPANY_SUGGESTIONS = 15
+# Журнал запросов (JSONL с ротацией) и ограничения объёма сканирования для поиска по фильтрам (0 - без ограничения)
+QUERY_LOG_PATH = os.environ.get("QUERY_LOG_PATH", os.path.join("data", "query_log.jsonl"))
+QUERY_LOG_MAX_BYTES = int(os.environ.get("QUERY_LOG_MAX_BYTES", 10 * 1024 * 1024))
+QUERY_LOG_BACKUPS = int(os.environ.get("QUERY_LOG_BACKUPS", 5))
+QUERY_STATS_KEEP = 200
+SCAN_WARN_BYTES = int(float(os.environ.get("SCAN_WARN_GB", 10)) * 1024 ** 3)
+SCAN_BLOCK_BYTES = int(float(os.environ.get("SCAN_BLOCK_GB", 100)) * 1024 ** 3)
+RESULTS_PAGE_SIZE = int(os.environ.get("RESULTS_PAGE_SIZE", 1000))
+# Страницы результатов общие для всех сессий экземпляра (result_store.py): бюджет памяти и срок жизни
+RESULT_STORE_MAX_BYTES = int(os.environ.get("RESULT_STORE_MAX_BYTES", 128 * 1024 * 1024))
+RESULT_STORE_TTL = int(os.environ.get("RESULT_STORE_TTL", 3600))
+EXPORT_MAX_ROWS = int(os.environ.get("EXPORT_MAX_ROWS", 2000000))
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 20000))
+# Файлы экспорта старше этого удаляются при старте новой сессии или следующем экспорте
+EXPORT_FILE_MAX_AGE = int(os.environ.get("EXPORT_FILE_MAX_AGE", 3600))
+# Пул потоков для параллельных и отменяемых запросов (query_jobs.py), общий для всех сессий экземпляра
+QUERY_WORKERS = int(os.environ.get("QUERY_WORKERS", 8))
+# После неудачной сборки индекса (кодов, компаний, описаний) до повтора идут SQL-запросы; пауза удваивается до максимума
+INDEX_RETRY_AFTER = int(os.environ.get("INDEX_RETRY_AFTER", 300))
+INDEX_RETRY_MAX = int(os.environ.get("INDEX_RETRY_MAX", 3600))
+JOB_POLL_INTERVAL = 0.25
 
 # --- СЛОВАРЬ ДЛЯ ОПИСАНИЯ ГРУПП УКТЗЕД ---
 GROUP_DESCRIPTIONS = {
@@ -45,20 +99,21 @@ GROUP_DESCRIPTIONS = {
     '97': 'Твори мистецтва, предмети колекціонування'
 }
 
-@st.cache_data
-def to_excel(df):
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Data')
-    processed_data = output.getvalue()
-    return processed_data
-
 # --- ФУНКЦИИ --- (без изменений)
 
+def get_secret(name):
+    # Сначала переменная окружения (Cloud Run, локальный запуск), затем .streamlit/secrets.toml -
+    # независимо от бэкенда запросов
+    value = os.environ.get(name)
+    if value: return value
+    try:
+        return st.secrets.get(name)
+    except Exception:
+        return None  # файла secrets.toml нет
+
 def check_password():
     def password_entered():
-        if os.environ.get('K_SERVICE'): correct_password = os.environ.get("APP_PASSWORD")
-        else: correct_password = st.secrets.get("APP_PASSWORD")
+        correct_password = get_secret("APP_PASSWORD")
         if st.session_state.get("password") and st.session_state["password"] == correct_password:
             st.session_state["password_correct"] = True; del st.session_state["password"]
         else: st.session_state["password_correct"] = False
@@ -70,47 +125,417 @@ def check_password():
 def initialize_clients():
     if 'clients_initialized' in st.session_state: return
     try:
-        if os.environ.get('K_SERVICE'):
-            st.session_state.bq_client = bigquery.Client(project=PROJECT_ID)
-            api_key = os.environ.get("GOOGLE_AI_API_KEY")
-        else:
-            st.session_state.bq_client = bigquery.Client()
-            api_key = st.secrets.get("GOOGLE_AI_API_KEY")
+        if os.environ.get('K_SERVICE'): bq_client_factory = lambda: bigquery.Client(project=PROJECT_ID)
+        else: bq_client_factory = bigquery.Client
+        api_key = get_secret("GOOGLE_AI_API_KEY")
+        st.session_state.backend = create_backend(QUERY_BACKEND, TABLE_ID, bq_client_factory=bq_client_factory, parquet_path=LOCAL_PARQUET_PATH, typed=USE_TYPED_TABLE)
         if api_key:
             genai.configure(api_key=api_key)
             st.session_state.genai_ready = True
         st.session_state.clients_initialized = True
+        cleanup_exports(EXPORT_FILE_MAX_AGE)
         st.session_state.client_ready = True
     except Exception as e:
         st.error(f"Помилка аутентифікації в Google: {e}"); st.session_state.client_ready = False
 
-def run_query(query, job_config=None):
+def get_dialect():
+    return st.session_state.backend.dialect
+
+@st.cache_resource
+def get_query_cache():
+    return QueryResultCache(max_bytes=QUERY_CACHE_MAX_BYTES, ttl=QUERY_CACHE_TTL)
+
+@st.cache_resource
+def get_query_log():
+    return QueryLog(QUERY_LOG_PATH, max_bytes=QUERY_LOG_MAX_BYTES, backup_count=QUERY_LOG_BACKUPS)
+
+def remember_query_stats(stats):
+    if 'query_stats' not in st.session_state: st.session_state.query_stats = []
+    st.session_state.query_stats.append(stats); del st.session_state.query_stats[:-QUERY_STATS_KEEP]
+
+def record_query_stats(stats):
+    get_query_log().record(stats); remember_query_stats(stats)
+
+def measure(site, query, params=None, backend=None):
+    backend = backend or st.session_state.backend
+    return measure_query(site, query, params, backend.dialect.name, on_record=record_query_stats)
+
+def timed_query(backend, query, params, site):
+    # Запрос мимо кэша результатов (построение индексов), но с записью в журнал
+    with measure(site, query, params, backend) as stats:
+        df = backend.query(query, params, stats=stats); stats.update(frame_stats(df))
+    return df
+
+def fetch_cached(backend, cache, query, params, stats, handle=None):
+    key = cache_key(query, params)
+    df = cache.get(key)
+    if df is not None: stats.update(cache_hit=True, cache='app')
+    else:
+        df = cache.put(key, backend.query(query, params, stats=stats, handle=handle))
+    stats.update(frame_stats(df))
+    return df
+
+def run_query(query, params=None, site='other'):
     if st.session_state.get('client_ready', False):
+        backend = st.session_state.backend; cache = get_query_cache()
+        cache.sync_version(backend.table_version)
         try:
-            return st.session_state.bq_client.query(query, job_config=job_config).to_dataframe()
+            with measure(site, query, params) as stats:
+                return fetch_cached(backend, cache, query, params, stats)
         except Exception as e:
-            st.error(f"Помилка під час виконання запиту до BigQuery: {e}")
+            st.error(f"Помилка під час виконання запиту до бази даних: {e}")
             return pd.DataFrame()
     return pd.DataFrame()
 
+def get_table_version():
+    cache = get_query_cache(); cache.sync_version(st.session_state.backend.table_version)
+    return cache.table_version
+
+# --- ЗАДАНИЯ В ПУЛЕ (см. query_jobs.py) ---
+# Функции заданий получают handle и on_record и не обращаются к st.*: журнал пишется из пула,
+# а в панель диагностики сессии записи переносит основной поток, дождавшись задания.
+
+@st.cache_resource
+def get_query_executor():
+    return QueryExecutor(max_workers=QUERY_WORKERS)
+
+def session_id():
+    if 'session_id' not in st.session_state: st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+def job_recorder(handle, log):
+    def on_record(stats):
+        log.record(stats); handle.records.append(stats)
+    return on_record
+
+def submit_job(group, fn, *args, supersede=True):
+    # fn(handle, on_record, *args); supersede - отменить незавершённые задания сессии в этой группе
+    log = get_query_log()
+    return get_query_executor().submit(session_id(), group, lambda handle: fn(handle, job_recorder(handle, log), *args), supersede=supersede)
+
+def cancel_session_jobs(group=None):
+    if 'session_id' in st.session_state: get_query_executor().cancel(st.session_state.session_id, group)
+
+def collect_job_stats(handle):
+    for stats in handle.records: remember_query_stats(stats)
+    handle.records = []
+
+def wait_for_jobs(handles, message, on_update=None):
+    # Ожидание с обновлением подписи: на вызове st.* Streamlit прерывает устаревший прогон скрипта
+    # (пользователь изменил ввод), и незавершённые задания отменяются вместо того, чтобы дорабатывать впустую
+    status = st.empty(); started = time.perf_counter(); pending = list(handles)
+    try:
+        while True:
+            status.caption(f"⏳ {message} {time.perf_counter() - started:.0f} с")
+            pending = wait_any(pending, timeout=JOB_POLL_INTERVAL)
+            if on_update is not None: on_update()
+            if not pending: break
+    except BaseException:
+        for handle in handles: handle.cancel()
+        raise
+    status.empty()
+    for handle in handles: collect_job_stats(handle)
+
+def query_task(handle, on_record, backend, cache, query, params, site):
+    with measure_query(site, query, params, backend.dialect.name, on_record=on_record) as stats:
+        return fetch_cached(backend, cache, query, params, stats, handle=handle)
+
+def frame_task(handle, on_record, backend, query, params, site):
+    # Мимо кэша результатов - исходные данные индексов
+    with measure_query(site, query, params, backend.dialect.name, on_record=on_record) as stats:
+        df = backend.query(query, params, stats=stats, handle=handle); stats.update(frame_stats(df))
+    return df
+
+def shared_frame_job(key, backend, query, params, site):
+    log = get_query_log()
+    return get_query_executor().shared(key, lambda handle: frame_task(handle, job_recorder(handle, log), backend, query, params, site), label=site)
+
+def shared_frame(key, backend, query, params, site):
+    # Результат общего задания: уже запущенного warm_up (или другой сессией) либо запущенного здесь
+    handle = shared_frame_job(key, backend, query, params, site)
+    try:
+        return handle.result()
+    finally:
+        get_query_executor().release(key); collect_job_stats(handle)
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def warm_up(table_version, _backend):
+    # Раз на версию таблицы: исходные данные индекса кодов читаются в пуле, пока скрипт
+    # строит каталог фильтров - load_code_index заберёт готовый (или ещё идущий) результат.
+    # Задание не возвращается: иначе кэш держал бы исходный кадр индекса и после release()
+    shared_frame_job(('code_index', table_version), _backend, *code_index_query(_backend.dialect), 'code_index')
+
+@st.cache_resource(max_entries=1, show_spinner="Будуємо індекс кодів УКТЗЕД...")
+def load_code_index(table_version, _backend):
+    # Индекс перестраивается только когда меняется версия таблицы (новая загрузка данных)
+    return CodeIndex.from_frame(shared_frame(('code_index', table_version), _backend, *code_index_query(_backend.dialect), 'code_index'))
+
+@st.cache_resource
+def get_index_failures():
+    # (индекс, версия таблицы) -> (время последней неудачи, число неудач подряд); общий для сессий, как и сами индексы.
+    # cache_resource не кэширует исключения - без этого каждая перерисовка заново запускала бы полное сканирование.
+    return {}
+
+def load_index(name, loader):
+    # None - индекс недоступен (сборка не удалась недавно или только что), вызывающий код идёт по SQL-пути
+    version = get_table_version(); failures = get_index_failures(); key = (name, version)
+    failure = failures.get(key)
+    if failure is not None and time.monotonic() - failure[0] < min(INDEX_RETRY_AFTER * 2 ** (failure[1] - 1), INDEX_RETRY_MAX): return None
+    try:
+        index = loader(version, st.session_state.backend)
+    except Exception:
+        for stale in [k for k in failures if k[0] == name and k != key]: failures.pop(stale, None)
+        failures[key] = (time.monotonic(), failure[1] + 1 if failure else 1)
+        return None
+    failures.pop(key, None)
+    return index
+
+def get_code_index():
+    return load_index('code_index', load_code_index)
+
+@st.cache_resource(max_entries=1, show_spinner="Індексуємо назви компаній...")
+def load_company_index(table_version, _backend):
+    return CompanyIndex.from_frame(timed_query(_backend, *company_index_query(_backend.dialect), site='company_index'))
+
+def get_company_index():
+    return load_index('company_index', load_company_index)
+
+def resolve_company_match(company_terms):
+    # Выбранные в подсказках компании точнее введённого текста; иначе текст разрешается индексом в набор кодов
+    selected = st.session_state.get('selected_companies', [])
+    if selected: return {'codes': list(selected), 'names': []}
+    if not company_terms: return None
+    company_index = get_company_index()
+    if company_index is None: return None
+    codes, names = company_index.resolve(company_terms)
+    if len(codes) + len(names) > COMPANY_MATCH_MAX_CODES: return None
+    return {'codes': codes, 'names': names}
+
+def format_company(company_index, code):
+    company = company_index.by_code.get(code)
+    if company is None: return code
+    return f"{company.name} · ЄДРПОУ {code} · {company.declarations:,} декл.".replace(',', ' ')
+
+@st.cache_resource
+def get_result_store():
+    return ResultStore(max_bytes=RESULT_STORE_MAX_BYTES, ttl=RESULT_STORE_TTL)
+
+def new_search(query, params, site):
+    # В сессии - только состояние постраничного чтения (токены известных страниц, номер страницы);
+    # сами страницы лежат в общем хранилище под идентификатором результата
+    return {
+        'sql': query, 'params': params, 'tokens': [None], 'page_index': 0, 'site': site,
+        'result_id': result_id(query, params, get_table_version()), 'total_rows': None,
+    }
+
+def page_request(search, page_index):
+    # Снимок состояния поиска для задания: словарь сессии в пул не передаётся
+    return {key: search[key] for key in ('sql', 'params', 'site', 'result_id')} | {'page_index': page_index, 'token': search['tokens'][page_index]}
+
+def page_task(handle, on_record, backend, store, request):
+    key = (request['result_id'], request['page_index'])
+    page = store.get(key)
+    if page is not None: return page
+    with measure_query(request['site'], request['sql'], request['params'], backend.dialect.name, on_record=on_record) as stats:
+        df, next_token = backend.page(request['sql'], request['params'], request['token'], RESULTS_PAGE_SIZE, stats=stats, handle=handle)
+        stats.update(frame_stats(df))
+    page = ResultPage(compact_frame(df), next_token); store.put(key, page, page.nbytes)
+    return page
+
+def submit_page(search, page_index, group, supersede=True):
+    return submit_job(group, page_task, st.session_state.backend, get_result_store(), page_request(search, page_index), supersede=supersede)
+
+def run_search(search, count, count_site, message):
+    # Точное число строк - отдельный дешёвый COUNT; он и первая страница независимы и выполняются параллельно.
+    # Новое задание группы отменяет незавершённые задания прежнего поиска этого вида.
+    get_table_version()
+    count_job = submit_job(search['site'], query_task, st.session_state.backend, get_query_cache(), *count, count_site)
+    page_job = submit_page(search, 0, search['site'], supersede=False)
+    try:
+        wait_for_jobs([count_job, page_job], message)
+        total_df = count_job.result(); page_job.result()
+    except JobCancelled:
+        return None
+    except Exception as e:
+        st.error(f"Помилка під час виконання запиту до бази даних: {e}"); return None
+    search['total_rows'] = int(total_df['total_rows'].iloc[0]) if not total_df.empty else None
+    return search
+
+def pending_prefetch(key):
+    prefetch = st.session_state.get('prefetch')
+    if prefetch is None or prefetch['key'] != key or not prefetch['handle'].usable(): return None
+    return prefetch['handle']
+
+def load_results_page(search, page_index):
+    # Страница читается из базы один раз на результат: повторные перерисовки и другие сессии
+    # с тем же запросом получают готовый компактный кадр вместе с токеном следующей страницы
+    key = (search['result_id'], page_index)
+    page = get_result_store().get(key)
+    if page is None:
+        # Переход на страницу, которая уже подгружается в фоне, дожидается этой подгрузки
+        handle = pending_prefetch(key) or submit_page(search, page_index, f"{search['site']}_page")
+        try:
+            wait_for_jobs([handle], "Завантажуємо сторінку результатів...")
+            page = handle.result()
+        except JobCancelled:
+            return ResultPage(pd.DataFrame())
+        except Exception as e:
+            st.error(f"Помилка під час завантаження сторінки результатів: {e}"); return ResultPage(pd.DataFrame())
+    if page.next_token and len(search['tokens']) == page_index + 1: search['tokens'].append(page.next_token)
+    return page
+
+def labelled_view(page, labels):
+    # Подписи колонок для таблицы - представление, построенное один раз на страницу
+    return page.view(('labels', tuple(labels.items())), lambda frame: frame.rename(columns=labels))
+
+def change_results_page(search_key, delta):
+    st.session_state[search_key]['page_index'] += delta
+
+def page_navigation(search_key, page_df):
+    search = st.session_state[search_key]; page_index = search['page_index']
+    if page_index == 0 and len(search['tokens']) <= 1: return
+    first_row = page_index * RESULTS_PAGE_SIZE
+    total_rows = search['total_rows'] if search['total_rows'] is not None else first_row + len(page_df)
+    n1, n2, n3 = st.columns([1, 3, 1])
+    n1.button("⬅️ Попередня сторінка", on_click=change_results_page, args=(search_key, -1), disabled=page_index == 0, use_container_width=True, key=f"{search_key}_prev")
+    n2.caption(f"Сторінка {page_index + 1} з {-(-total_rows // RESULTS_PAGE_SIZE)}: рядки {first_row + 1}–{first_row + len(page_df)}")
+    n3.button("Наступна сторінка ➡️", on_click=change_results_page, args=(search_key, 1), disabled=len(search['tokens']) <= page_index + 1, use_container_width=True, key=f"{search_key}_next")
+
+def discard_export_file():
+    export_file = st.session_state.pop('export_file', None)
+    if export_file and os.path.exists(export_file['path']): os.remove(export_file['path'])
+
+def export_task(handle, on_record, backend, request, fmt, labels, columns):
+    with measure_query(f"{request['site']}_export", request['sql'], request['params'], backend.dialect.name, on_record=on_record) as stats:
+        batches = backend.iter_batches(request['sql'], request['params'], batch_size=EXPORT_BATCH_SIZE, stats=stats, handle=handle)
+        path, rows, truncated = export_to_tempfile(checked(batches, handle), fmt, labels=labels, columns=columns, max_rows=EXPORT_MAX_ROWS)
+        stats['rows'] = rows
+    return path, rows, truncated
+
+def prepare_export(search_key, fmt):
+    # Файл строится только по кнопке: весь отфильтрованный набор читается батчами прямо в файл на диске.
+    # Выгрузка - самый долгий запрос, поэтому тоже идёт заданием: новый поиск или изменённый ввод её отменяют.
+    search = st.session_state[search_key]
+    labels, columns = (COMPANY_LABELS, list(COMPANY_LABELS)) if search_key == 'company_search' else (COLUMN_LABELS, DISPLAY_COLUMNS)
+    discard_export_file(); cleanup_exports(EXPORT_FILE_MAX_AGE)
+    request = {key: search[key] for key in ('sql', 'params', 'site')}
+    job = submit_job('export', export_task, st.session_state.backend, request, fmt, labels, columns)
+    try:
+        wait_for_jobs([job], "Формуємо файл...")
+        path, rows, truncated = job.result()
+    except JobCancelled:
+        return
+    except Exception as e:
+        st.error(f"Помилка під час формування файлу експорту: {e}"); return
+    st.session_state.export_file = {'path': path, 'format': fmt, 'rows': rows, 'truncated': truncated, 'search_key': search_key, 'result_id': search['result_id']}
+
+def export_controls(search_key):
+    e1, e2 = st.columns([1, 3])
+    fmt = e1.selectbox("Формат файлу:", options=list(EXPORT_FORMATS), format_func=lambda f: EXPORT_FORMATS[f]['label'], key="export_format")
+    if e2.button("📦 Підготувати файл з усіма знайденими записами", key="prepare_export"):
+        with st.spinner("Формуємо файл..."): prepare_export(search_key, fmt)
+    export_file = st.session_state.get('export_file')
+    search = st.session_state[search_key]
+    if export_file and export_file['search_key'] == search_key and export_file['result_id'] == search['result_id'] and os.path.exists(export_file['path']):
+        if export_file['truncated']:
+            st.warning(f"Файл обмежено {EXPORT_MAX_ROWS:,} рядками.".replace(',', ' '))
+        st.download_button(
+            label=f"📥 Завантажити {EXPORT_FORMATS[export_file['format']]['label']} ({export_file['rows']:,} рядків)".replace(',', ' '),
+            data=partial(read_export_file, export_file['path']),
+            file_name=f"customs_data_export{EXPORT_FORMATS[export_file['format']]['suffix']}",
+            mime=EXPORT_FORMATS[export_file['format']]['mime']
+        )
+
+def estimate_scan(queries, site):
+    # Сумма оценок dry run по запросам поиска; None - движок оценку не даёт (DuckDB) или она не удалась
+    backend = st.session_state.backend; total = 0
+    for query, params in queries:
+        try:
+            with measure(f"{site}_dry_run", query, params) as stats:
+                stats['bytes_processed'] = estimate = backend.dry_run(query, params)
+        except Exception:
+            return None
+        if estimate is None: return None
+        total += estimate
+    return total
+
+def check_scan_budget(queries, site):
+    # Дорогие поиски предупреждаются, а сверх SCAN_BLOCK_BYTES не выполняются
+    estimate = estimate_scan(queries, site)
+    if estimate is None: return True
+    if SCAN_BLOCK_BYTES and estimate > SCAN_BLOCK_BYTES:
+        st.error(f"Запит не виконано: орієнтовний обсяг сканування {format_bytes(estimate)} перевищує ліміт {format_bytes(SCAN_BLOCK_BYTES)}. Звузьте фільтри (роки, місяці, коди УКТЗЕД).")
+        return False
+    if SCAN_WARN_BYTES and estimate > SCAN_WARN_BYTES:
+        st.warning(f"Дорогий запит: орієнтовний обсяг сканування {format_bytes(estimate)}.")
+    return True
+
+def show_query_diagnostics():
+    records = st.session_state.get('query_stats', [])
+    with st.expander(f"🩺 Діагностика запитів ({len(records)})"):
+        # Кэш результатов общий для процесса - его счётчики показываются и до первого запроса сессии
+        cache = get_query_cache().stats()
+        st.caption(f"Кеш результатів: {cache['entries']} записів, {format_bytes(cache['bytes'])} з {format_bytes(cache['max_bytes'])}; "
+                   f"влучань {cache['hits']}, промахів {cache['misses']} ({cache['hit_rate']:.0%}); "
+                   f"витіснено {cache['evictions']}, інвалідовано {cache['invalidations']}.")
+        if not records:
+            st.caption("У цій сесії ще не було запитів."); return
+        summary = summarize_stats(records)
+        st.caption(f"Тарифіковано за сесію: {format_bytes(summary['bytes_billed'].sum())}; оброблено: {format_bytes(summary['bytes_processed'].sum())}. Журнал: {QUERY_LOG_PATH}")
+        in_flight = get_query_executor().in_flight(session_id())
+        if in_flight: st.caption("Виконуються у фоні: " + ", ".join(job.label for job in in_flight))
+        st.dataframe(summary, use_container_width=True, hide_index=True)
+        st.dataframe(stats_frame(reversed(records)).rename(columns=STATS_LABELS), use_container_width=True, hide_index=True)
+
+def prefetch_next_page(search_key):
+    # Страница уже отрисована - следующая подгружается в пуле, пока пользователь смотрит текущую.
+    # Новая подгрузка отменяет прежнюю, если та ещё не завершилась.
+    search = st.session_state.get(search_key)
+    if not search or len(search['tokens']) <= search['page_index'] + 1: return
+    key = (search['result_id'], search['page_index'] + 1)
+    prefetch = st.session_state.get('prefetch')
+    if prefetch is not None:
+        if prefetch['key'] == key: return
+        if prefetch['handle'].done(): collect_job_stats(prefetch['handle'])
+    if get_result_store().get(key) is not None: return
+    st.session_state.prefetch = {'key': key, 'handle': submit_page(search, key[1], 'prefetch')}
+
+@st.cache_resource
+def get_suggestion_cache():
+    return SuggestionCache(AI_SUGGESTION_CACHE_PATH, ttl=AI_SUGGESTION_CACHE_TTL, max_entries=AI_SUGGESTION_CACHE_MAX_ENTRIES)
+
+@st.cache_resource(max_entries=1, show_spinner="Індексуємо описи товарів...")
+def load_description_index(table_version, _backend):
+    return DescriptionIndex.from_frame(timed_query(_backend, *description_index_query(_backend.dialect), site='description_index'))
+
+def get_description_index():
+    return load_index('description_index', load_description_index)
+
+def show_local_candidates(candidates):
+    # Показываются сразу, пока модель ещё думает
+    st.info("Схожі описи в базі: " + "; ".join(f"`{c.code}` - {c.description} ({c.declarations})" for c in candidates[:5]))
+
 def get_ai_code_suggestions(product_description):
-    if not st.session_state.get('genai_ready', False): return None
-    prompt = f"""
-    Ти експерт з митної класифікації та українських кодів УКТЗЕД. Проаналізуй опис товару та надай список потенційних кодів УКТЗЕД.
-    Включи коди різної довжини (наприклад, 4, 6, 10 знаків). Твоя відповідь МАЄ БУТИ ТІЛЬКИ у форматі JSON, що є єдиним списком рядків.
-    Приклад правильної відповіді: ["8517", "851712", "8517120000"] Не додавай жодних описів, пояснень чи іншого тексту поза межами JSON-масиву.
-    ОПИС ТОВАРУ: "{product_description}"
-    """
+    model_client = GeminiModelClient() if st.session_state.get('genai_ready', False) else None
+    service = CodeSuggestionService(model_client, cache=get_suggestion_cache(), index=get_description_index())
+    # Модель отвечает в пуле; тем временем основной поток готовит индекс кодов для проверки ответа,
+    # а локальные кандидаты показываются, как только они найдены
+    job = submit_job('ai', lambda handle, on_record: service.suggest(product_description, on_candidates=handle.updates.append))
+    get_code_index()
+    def show_updates():
+        while job.updates: show_local_candidates(job.updates.pop(0))
     try:
-        model = genai.GenerativeModel('models/gemini-pro-latest')
-        generation_config = genai.types.GenerationConfig(response_mime_type="application/json")
-        response = model.generate_content(prompt, generation_config=generation_config)
-        cleaned_text = response.text.strip().replace("```json", "").replace("```", "").strip()
-        response_json = json.loads(cleaned_text)
-        if isinstance(response_json, list) and all(isinstance(i, str) for i in response_json): return response_json
-        else: st.error("AI повернув дані у неочікуваному форматі."); return []
+        wait_for_jobs([job], "Очікуємо відповідь AI...", on_update=show_updates)
+        suggestion = job.result()
+    except JobCancelled:
+        return None
+    except UnexpectedModelResponse as e:
+        st.error(str(e)); return []
     except Exception as e:
         st.error(f"Помилка при отриманні кодів від AI: {e}"); return None
+    if suggestion.source == 'cache': st.caption("Коди взято з кешу попередніх запитів.")
+    elif suggestion.source == 'local': st.caption("Коди підібрано за схожими описами в базі, без звернення до AI.")
+    return suggestion.codes
 
 def find_and_validate_codes(product_description):
     theoretical_codes = get_ai_code_suggestions(product_description)
@@ -119,19 +544,12 @@ def find_and_validate_codes(product_description):
     unique_codes = list(set(filter(None, theoretical_codes)))
     if not unique_codes:
         st.warning("Відповідь AI не містить кодів для перевірки."); return None, [], []
-    query_parts = []; query_params = []
-    for i, code in enumerate(unique_codes):
-        param_name = f"code{i}"; query_parts.append(f"STARTS_WITH(kod_uktzed, @{param_name})")
-        query_params.append(ScalarQueryParameter(param_name, "STRING", code))
-    where_clause = " OR ".join(query_parts)
-    validation_query = f"""
-    WITH BaseData AS (SELECT kod_uktzed, opis_tovaru, SAFE_CAST(mytna_vartist_hrn AS FLOAT64) as customs_value FROM `{TABLE_ID}` WHERE ({where_clause}) AND kod_uktzed IS NOT NULL),
-    RankedDescriptions AS (SELECT kod_uktzed, opis_tovaru, ROW_NUMBER() OVER(PARTITION BY kod_uktzed ORDER BY COUNT(*) DESC) as rn FROM BaseData WHERE opis_tovaru IS NOT NULL GROUP BY kod_uktzed, opis_tovaru),
-    Aggregates AS (SELECT kod_uktzed, COUNT(*) as total_declarations, SUM(customs_value) as total_value, AVG(customs_value) as avg_value FROM BaseData GROUP BY kod_uktzed)
-    SELECT a.kod_uktzed AS `Код УКТЗЕД в базі`, rd.opis_tovaru AS `Найчастіший опис в базі`, a.total_declarations AS `Кількість декларацій`, a.total_value AS `Загальна вартість грн`, a.avg_value AS `Середня вартість грн`
-    FROM Aggregates a JOIN RankedDescriptions rd ON a.kod_uktzed = rd.kod_uktzed WHERE rd.rn = 1 ORDER BY a.total_declarations DESC LIMIT 50
-    """
-    job_config = QueryJobConfig(query_parameters=query_params); validated_df = run_query(validation_query, job_config=job_config)
+    code_index = get_code_index()
+    if code_index is not None:
+        validated_df = code_index.validate(unique_codes)
+    else:
+        validation_query, query_params = code_validation_query(unique_codes, get_dialect())
+        validated_df = run_query(validation_query, query_params, site='ai_validation')
     if validated_df is not None and not validated_df.empty:
         pd.options.display.float_format = '{:,.2f}'.format
         validated_df['Загальна вартість грн'] = validated_df['Загальна вартість грн'].apply(lambda x: f"{x:,.2f}" if pd.notnull(x) else "N/A")
@@ -145,30 +563,101 @@ def find_and_validate_codes(product_description):
     unfound_codes = set(unique_codes) - found_prefixes
     return validated_df, list(found_prefixes), list(unfound_codes)
 
-@st.cache_data(ttl=3600)
+def start_warm_up():
+    try:
+        warm_up(get_table_version(), st.session_state.backend)
+    except Exception:
+        pass  # индекс построится по первому обращению, запросы падают обратно на SQL
+
+@st.cache_data(ttl=CATALOG_MAX_AGE)
 def get_filter_options():
-    options = {}
-    options['direction'] = ['Імпорт', 'Експорт']
-    query_countries = f"SELECT DISTINCT kraina_partner FROM `{TABLE_ID}` WHERE kraina_partner IS NOT NULL ORDER BY kraina_partner"
-    options['countries'] = list(run_query(query_countries)['kraina_partner'])
-    query_transport = f"SELECT DISTINCT vyd_transportu FROM `{TABLE_ID}` WHERE vyd_transportu IS NOT NULL ORDER BY vyd_transportu"
-    options['transport'] = list(run_query(query_transport)['vyd_transportu'])
-    query_years = f"SELECT DISTINCT EXTRACT(YEAR FROM SAFE_CAST(data_deklaracii AS DATE)) as year FROM `{TABLE_ID}` WHERE data_deklaracii IS NOT NULL ORDER BY year DESC"
-    options['years'] = list(run_query(query_years)['year'].dropna().astype(int))
-    query_months = f"SELECT DISTINCT EXTRACT(MONTH FROM SAFE_CAST(data_deklaracii AS DATE)) as month FROM `{TABLE_ID}` WHERE data_deklaracii IS NOT NULL ORDER BY month"
-    options['months'] = list(run_query(query_months)['month'].dropna().astype(int))
-    query_groups = f"SELECT DISTINCT SUBSTR(kod_uktzed, 1, 2) as group_code FROM `{TABLE_ID}` WHERE LENGTH(kod_uktzed) >= 2 ORDER BY group_code"
-    options['groups'] = list(run_query(query_groups)['group_code'].dropna())
-    return options
+    # Ошибка запроса поднимается исключением: каталог не сохраняется на диск и не кэшируется как пустой
+    backend = st.session_state.backend
+    catalog = refresh_catalog(FILTER_CATALOG_PATH, lambda query, params=None: timed_query(backend, query, params, 'filter_options'), backend.dialect, max_age=CATALOG_MAX_AGE)
+    return catalog.options()
+
+@st.cache_resource(ttl=ROLLUP_MAX_AGE, show_spinner="Оновлюємо зведені дані...")
+def get_rollup(_backend):
+    # Куб общий для всех сессий и только читается - поэтому cache_resource, без копирования при каждом обращении
+    return refresh_rollup(ROLLUP_PATH, lambda query, params=None: timed_query(_backend, query, params, 'rollup'), _backend.dialect, max_age=ROLLUP_MAX_AGE)
+
+def show_analytics():
+    try:
+        cube = get_rollup(st.session_state.backend)
+    except Exception as e:
+        st.error(f"Помилка під час побудови зведених даних: {e}"); return
+    if cube.is_empty():
+        st.warning("Зведені дані поки недоступні."); return
+    options = cube.options()
+    a1, a2, a3 = st.columns(3)
+    a1.multiselect("Напрямок:", options=options['directions'], key='analytics_directions')
+    a2.multiselect("Країна-партнер:", options=options['countries'], key='analytics_countries')
+    a3.multiselect("Вид транспорту:", options=options['transports'], key='analytics_transports')
+    a4, a5, a6, a7 = st.columns([1, 2, 1, 1])
+    a4.multiselect("Роки:", options=options['years'], key='analytics_years')
+    a5.text_input("Група / позиція УКТЗЕД (2 або 4 цифри, через кому):", key='analytics_hs')
+    metric = a6.selectbox("Показник:", options=METRIC_COLUMNS, format_func=METRIC_LABELS.get, key='analytics_metric')
+    top_n = a7.number_input("Топ партнерів:", min_value=3, max_value=30, value=10, key='analytics_top_n')
+    hs_input = process_text_input(st.session_state.analytics_hs)
+    hs_codes = [c for c in hs_input if len(c) in (2, 4)]
+    if len(hs_codes) < len(hs_input): st.caption("Зведені дані містять лише групи (2 цифри) і позиції (4 цифри) - інші коди пропущено.")
+    selection = {
+        'directions': st.session_state.analytics_directions, 'countries': st.session_state.analytics_countries,
+        'transports': st.session_state.analytics_transports, 'years': st.session_state.analytics_years, 'hs_codes': hs_codes,
+    }
+    if cube.watermark: st.caption(f"Дані по {cube.watermark:%d.%m.%Y}.")
+    series = cube.time_series(metric, by='direction', **selection)
+    if series.empty:
+        st.info("За обраними параметрами даних немає."); return
+    st.subheader("Динаміка по місяцях")
+    st.line_chart(series)
+    top = cube.top_partners(metric, n=int(top_n), **selection)
+    t1, t2 = st.columns([3, 2])
+    with t1:
+        st.subheader(f"Топ-{int(top_n)} країн-партнерів")
+        st.bar_chart(top.set_index('country')[metric])
+    with t2:
+        st.dataframe(
+            top.rename(columns={'country': 'Країна-партнер', metric: METRIC_LABELS[metric], 'share': 'Частка'}).style.format({'Частка': '{:.1%}'}),
+            use_container_width=True, hide_index=True,
+        )
+    st.subheader("Частки країн-партнерів по місяцях")
+    st.area_chart(cube.market_share(metric, n=min(int(top_n), 10), **selection))
+
+def format_with_count(dimension):
+    # Подпись значения фильтра с количеством записей из каталога: "CN (12 345)"
+    counts = get_filter_options()['counts'].get(dimension, {})
+    def format_option(value):
+        key = value.split(' - ')[0] if dimension == 'groups' else value
+        return f"{value} ({counts[key]:,})".replace(',', ' ') if key in counts else str(value)
+    return format_option
 
 def reset_all_filters():
     st.session_state.selected_directions = []; st.session_state.selected_countries = []; st.session_state.selected_transports = []
     st.session_state.selected_years = []; st.session_state.selected_months = []; st.session_state.selected_groups = []
     st.session_state.selected_positions = []; st.session_state.weight_from = 0; st.session_state.weight_to = 0
     st.session_state.uktzed_input = ""; st.session_state.yedrpou_input = ""; st.session_state.company_input = ""
-    if 'results_df' in st.session_state: del st.session_state.results_df
+    st.session_state.selected_companies = []
+    cancel_session_jobs(); st.session_state.pop('prefetch', None)
+    for key in ('search', 'company_search', 'company_search_failure'):
+        if key in st.session_state: del st.session_state[key]
+    discard_export_file()
     st.session_state.show_unique_companies = False
 
+def collect_filters():
+    selected_group_codes = [g.split(' - ')[0] for g in st.session_state.get('selected_groups', [])]
+    position_codes = [p.split(' - ')[0] for p in st.session_state.get('selected_positions', [])]
+    return {
+        'directions': st.session_state.selected_directions, 'countries': st.session_state.selected_countries,
+        'transports': st.session_state.selected_transports, 'years': st.session_state.selected_years,
+        'months': st.session_state.selected_months, 'weight_from': st.session_state.weight_from,
+        'weight_to': st.session_state.weight_to, 'group_codes': selected_group_codes, 'position_codes': position_codes,
+        'uktzed': process_text_input(st.session_state.uktzed_input), 'yedrpou': process_text_input(st.session_state.yedrpou_input),
+        'companies': process_text_input(st.session_state.company_input),
+        'company_match': resolve_company_match(process_text_input(st.session_state.company_input)),
+        'available_years': get_filter_options()['years'],
+    }
+
 # --- ОСНОВНОЙ ИНТЕРФЕЙС ПРИЛОЖЕНИЯ ---
 
 if not check_password():
@@ -185,7 +674,8 @@ st.markdown(f'<p class="version-badge">{APP_VERSION}</p>', unsafe_allow_html=Tru
 st.title("Аналітика Митних Даних 📈")
 initialize_clients()
 if not st.session_state.get('client_ready', False):
-    st.error("❌ Не вдалося підключитися до Google BigQuery."); st.stop()
+    st.error("❌ Не вдалося підключитися до бази даних."); st.stop()
+start_warm_up()
 
 st.header("🤖 AI-помічник по кодам УКТЗЕД")
 ai_code_description = st.text_input("Введіть опис товару для пошуку реальних кодів у вашій базі:", key="ai_code_helper_input")
@@ -215,7 +705,10 @@ if 'validated_df' in st.session_state:
 st.divider()
 
 # --- БЛОК РУЧНЫХ ФИЛЬТРОВ ---
-filter_options = get_filter_options()
+try:
+    filter_options = get_filter_options()
+except Exception as e:
+    st.error(f"Не вдалося завантажити значення фільтрів: {e}"); st.stop()
 if 'selected_directions' not in st.session_state:
     reset_all_filters()
 
@@ -225,12 +718,12 @@ st.markdown("---")
 
 c1, c2, c3 = st.columns(3)
 with c1: st.multiselect("Напрямок:", options=filter_options['direction'], key='selected_directions')
-with c2: st.multiselect("Країна-партнер:", options=filter_options['countries'], key='selected_countries')
-with c3: st.multiselect("Вид транспорту:", options=filter_options['transport'], key='selected_transports')
+with c2: st.multiselect("Країна-партнер:", options=filter_options['countries'], key='selected_countries', format_func=format_with_count('countries'))
+with c3: st.multiselect("Вид транспорту:", options=filter_options['transport'], key='selected_transports', format_func=format_with_count('transport'))
 
 c4, c5, c6 = st.columns(3)
-with c4: st.multiselect("Роки:", options=filter_options['years'], key='selected_years')
-with c5: st.multiselect("Місяці:", options=filter_options['months'], key='selected_months')
+with c4: st.multiselect("Роки:", options=filter_options['years'], key='selected_years', format_func=format_with_count('years'))
+with c5: st.multiselect("Місяці:", options=filter_options['months'], key='selected_months', format_func=format_with_count('months'))
 with c6:
     w_col1, w_col2 = st.columns(2)
     w_col1.number_input("Вага від, кг", min_value=0, step=100, key="weight_from")
@@ -239,30 +732,31 @@ with c6:
 c7, c8, c9 = st.columns(3)
 with c7: st.text_input("Код УКТЗЕД (через кому):", key='uktzed_input')
 with c8: st.text_input("Код ЄДРПОУ (через кому):", key='yedrpou_input')
-with c9: st.text_input("Назва компанії (через кому):", key='company_input')
+with c9:
+    st.text_input("Назва компанії (через кому):", key='company_input')
+    company_terms = process_text_input(st.session_state.company_input)
+    company_index = get_company_index() if company_terms or st.session_state.get('selected_companies') else None
+    if company_index is not None:
+        # Подсказки по последнему введённому названию: канонические названия с количеством деклараций
+        suggestions = company_index.autocomplete(company_terms[-1], limit=COMPANY_SUGGESTIONS) if company_terms else []
+        company_options = list(dict.fromkeys(list(st.session_state.get('selected_companies', [])) + [c.code for c in suggestions if c.code]))
+        st.multiselect("Уточнити компанію:", options=company_options, key='selected_companies', format_func=lambda code: format_company(company_index, code))
 
 st.markdown("---")
 cg, cp = st.columns([1, 3])
 with cg:
     group_options = [f"{g} - {GROUP_DESCRIPTIONS.get(g, 'Невідома група')}" for g in filter_options['groups']]
-    st.multiselect("Товарна група (2 цифри):", options=group_options, key='selected_groups')
+    st.multiselect("Товарна група (2 цифри):", options=group_options, key='selected_groups', format_func=format_with_count('groups'))
 with cp:
     selected_group_codes = [g.split(' - ')[0] for g in st.session_state.get('selected_groups', [])]
     position_options = []
     if selected_group_codes:
-        group_conditions = " OR ".join([f"STARTS_WITH(kod_uktzed, '{g}')" for g in selected_group_codes])
-        query_positions = f"""
-        WITH PositionCounts AS (
-            SELECT SUBSTR(kod_uktzed, 1, 4) AS pos_code, opis_tovaru, COUNT(*) AS frequency
-            FROM `{TABLE_ID}` WHERE ({group_conditions}) AND LENGTH(kod_uktzed) >= 4 GROUP BY pos_code, opis_tovaru
-        ),
-        RankedPositions AS (
-            SELECT pos_code, opis_tovaru, ROW_NUMBER() OVER(PARTITION BY pos_code ORDER BY frequency DESC) AS rn
-            FROM PositionCounts
-        )
-        SELECT pos_code, opis_tovaru AS pos_description FROM RankedPositions WHERE rn = 1 ORDER BY pos_code
-        """
-        position_df = run_query(query_positions)
+        code_index = get_code_index()
+        if code_index is not None:
+            position_df = code_index.positions(selected_group_codes)
+        else:
+            query_positions, query_params = positions_query(selected_group_codes, get_dialect())
+            position_df = run_query(query_positions, query_params, site='positions')
         if not position_df.empty:
             for _, row in position_df.iterrows():
                 position_options.append(f"{row['pos_code']} - {row['pos_description']}")
@@ -272,114 +766,79 @@ st.markdown("---")
 search_button_filters = st.button("🔍 Знайти за фільтрами", use_container_width=True, type="primary")
 
 if search_button_filters:
-    query_parts = []; query_params = []
-    def process_text_input(input_str): return [item.strip() for item in input_str.split(',') if item.strip()]
-    if st.session_state.selected_directions:
-        query_parts.append("napryamok IN UNNEST(@directions)"); query_params.append(ArrayQueryParameter("directions", "STRING", st.session_state.selected_directions))
-    if st.session_state.selected_countries:
-        query_parts.append("kraina_partner IN UNNEST(@countries)"); query_params.append(ArrayQueryParameter("countries", "STRING", st.session_state.selected_countries))
-    if st.session_state.selected_transports:
-        query_parts.append("vyd_transportu IN UNNEST(@transports)"); query_params.append(ArrayQueryParameter("transports", "STRING", st.session_state.selected_transports))
-    if st.session_state.selected_years:
-        query_parts.append("EXTRACT(YEAR FROM SAFE_CAST(data_deklaracii AS DATE)) IN UNNEST(@years)"); query_params.append(ArrayQueryParameter("years", "INT64", st.session_state.selected_years))
-    if st.session_state.selected_months:
-        query_parts.append("EXTRACT(MONTH FROM SAFE_CAST(data_deklaracii AS DATE)) IN UNNEST(@months)"); query_params.append(ArrayQueryParameter("months", "INT64", st.session_state.selected_months))
-    if st.session_state.weight_from > 0:
-        query_parts.append("SAFE_CAST(vaha_netto_kg AS FLOAT64) >= @weight_from"); query_params.append(ScalarQueryParameter("weight_from", "FLOAT64", st.session_state.weight_from))
-    if st.session_state.weight_to > 0 and st.session_state.weight_to >= st.session_state.weight_from:
-        query_parts.append("SAFE_CAST(vaha_netto_kg AS FLOAT64) <= @weight_to"); query_params.append(ScalarQueryParameter("weight_to", "FLOAT64", st.session_state.weight_to))
-    
-    selected_group_codes = [g.split(' - ')[0] for g in st.session_state.get('selected_groups', [])]
-    if st.session_state.get('selected_positions', []):
-        position_codes = [p.split(' - ')[0] for p in st.session_state.selected_positions]
-        conditions = [f"STARTS_WITH(kod_uktzed, '{p}')" for p in position_codes]
-        query_parts.append(f"({' OR '.join(conditions)})")
-    elif selected_group_codes:
-        conditions = [f"STARTS_WITH(kod_uktzed, '{g}')" for g in selected_group_codes]
-        query_parts.append(f"({' OR '.join(conditions)})")
-    
-    uktzed_list = process_text_input(st.session_state.uktzed_input)
-    if uktzed_list:
-        conditions = []
-        for i, item in enumerate(uktzed_list):
-            param_name = f"uktzed{i}"; conditions.append(f"kod_uktzed LIKE @{param_name}")
-            query_params.append(ScalarQueryParameter(param_name, "STRING", f"{item}%"))
-        query_parts.append(f"({' OR '.join(conditions)})")
-    yedrpou_list = process_text_input(st.session_state.yedrpou_input)
-    if yedrpou_list:
-        query_parts.append("kod_yedrpou IN UNNEST(@yedrpou)"); query_params.append(ArrayQueryParameter("yedrpou", "STRING", yedrpou_list))
-    company_list = process_text_input(st.session_state.company_input)
-    if company_list:
-        conditions = []
-        for i, item in enumerate(company_list):
-            param_name = f"company{i}"; conditions.append(f"UPPER(nazva_kompanii) LIKE @{param_name}")
-            query_params.append(ScalarQueryParameter(param_name, "STRING", f"%{item.upper()}%"))
-        query_parts.append(f"({' OR '.join(conditions)})")
-    
-    if not query_parts:
+    filters = collect_filters(); dialect = get_dialect()
+    final_query, query_params = search_query(filters, dialect)
+    for key in ('company_search', 'company_search_failure'): st.session_state.pop(key, None)
+    if final_query is None:
         st.warning("Будь ласка, оберіть хоча б один фільтр.")
-        st.session_state.results_df = pd.DataFrame() 
-    else:
-        where_clause = " AND ".join(query_parts)
-        final_query = f"SELECT * FROM `{TABLE_ID}` WHERE {where_clause} LIMIT 5000"
-        job_config = QueryJobConfig(query_parameters=query_params)
+        if 'search' in st.session_state: del st.session_state.search
+    elif check_scan_budget([(final_query, query_params), count_query(filters, dialect)], 'filter_search'):
+        # Новый поиск заменяет все незавершённые задания сессии: прежний поиск, фоновую подгрузку страниц
+        cancel_session_jobs(); st.session_state.pop('prefetch', None)
         with st.spinner("Виконується запит..."):
-            st.session_state.results_df = run_query(final_query, job_config=job_config)
+            search = run_search(new_search(final_query, query_params, 'filter_search'), count_query(filters, dialect), 'filter_count', "Виконується запит...")
+        if search is not None:
+            search['filters'] = filters; st.session_state.search = search
+        elif 'search' in st.session_state: del st.session_state.search
 
-# --- ИЗМЕНЕНИЕ: Логика для подсчета и отображения уникальных компаний ---
-if 'results_df' in st.session_state and st.session_state.results_df is not None:
-    results_df_original = st.session_state.results_df.copy() 
-    st.success(f"Знайдено {len(results_df_original)} записів.")
+search = st.session_state.get('search')
+if search:
+    page = load_results_page(search, search['page_index'])
+    total_rows = search['total_rows'] if search['total_rows'] is not None else len(page.frame)
+    st.success(f"Знайдено {total_rows:,} записів.".replace(',', ' '))
     
-    show_unique = st.checkbox("Показати тільки унікальні компанії", key="show_unique_companies")
+    u1, u2 = st.columns([1, 1])
+    show_unique = u1.checkbox("Показати тільки унікальні компанії", key="show_unique_companies")
+    company_sort = u2.selectbox("Сортувати компанії за:", options=list(COMPANY_SORTS), format_func=COMPANY_SORTS.get, key="company_sort", disabled=not show_unique)
     
-    if not results_df_original.empty:
-        ukrainian_column_names = {
-            'data_deklaracii': 'Дата декларації', 'napryamok': 'Напрямок', 'nazva_kompanii': 'Назва компанії',
-            'kod_yedrpou': 'Код ЄДРПОУ', 'kraina_partner': 'Країна-партнер', 'kod_uktzed': 'Код УКТЗЕД',
-            'opis_tovaru': 'Опис товару', 'mytna_vartist_hrn': 'Митна вартість, грн', 'vaha_netto_kg': 'Вага нетто, кг',
-            'vyd_transportu': 'Вид транспорту'
-        }
-        results_df = results_df_original.rename(columns=ukrainian_column_names)
-        
-        numeric_cols = ['Митна вартість, грн', 'Вага нетто, кг']
-        for col in numeric_cols:
-            if col in results_df.columns:
-                results_df[col] = pd.to_numeric(results_df[col], errors='coerce')
-        
-        # Логика для подсчета и отображения уникальных
-        if show_unique and 'Назва компанії' in results_df.columns:
-            # Считаем количество деклараций для каждой компании ДО удаления дубликатов
-            company_counts = results_df['Назва компанії'].value_counts().reset_index()
-            company_counts.columns = ['Назва компанії', 'Кількість декларацій (у фільтрі)']
-            
-            # Удаляем дубликаты, оставляя первую строку для каждой компании
-            display_df = results_df.drop_duplicates(subset=['Назва компанії'], keep='first')
-            
-            # Объединяем с подсчитанным количеством
-            display_df = pd.merge(display_df, company_counts, on='Назва компанії', how='left')
-            
-            st.info(f"Відображено {len(display_df)} унікальних компаній.")
-            
-            # Перемещаем новую колонку на видное место (например, после названия компании)
-            if 'Кількість декларацій (у фільтрі)' in display_df.columns:
-                 cols = list(display_df.columns)
-                 count_col_index = cols.index('Кількість декларацій (у фільтрі)')
-                 name_col_index = cols.index('Назва компанії')
-                 # Убираем колонку со старого места и вставляем после 'Назва компанії'
-                 cols.pop(count_col_index)
-                 cols.insert(name_col_index + 1, 'Кількість декларацій (у фільтрі)')
-                 display_df = display_df[cols]
-
+    # Уникальные компании считает база по всему отфильтрованному набору (GROUP BY код ЄДРПОУ или название), а не pandas по странице
+    # Неудачная или заблокированная агрегация запоминается для (поиск, сортировка) и повторяется
+    # только по кнопке - иначе каждая перерисовка заново запускала бы dry run и полный GROUP BY
+    if show_unique:
+        company_search = st.session_state.get('company_search')
+        if company_search is not None and company_search['sort_by'] != company_sort: company_search = None
+        attempt = (search['result_id'], company_sort)
+        failure = st.session_state.get('company_search_failure')
+        if failure is not None and failure['attempt'] != attempt: failure = None
+        if company_search is None and failure is None:
+            dialect = get_dialect()
+            company_queries = [company_query(search['filters'], dialect, company_sort), company_count_query(search['filters'], dialect)]
+            if check_scan_budget(company_queries, 'company_search'):
+                with st.spinner("Агрегуємо дані по компаніях..."):
+                    company_search = run_search(new_search(*company_queries[0], 'company_search'), company_queries[1], 'company_count', "Агрегуємо дані по компаніях...")
+                if company_search is not None:
+                    company_search['sort_by'] = company_sort
+                    st.session_state.company_search = company_search
+                else: st.session_state.company_search_failure = {'attempt': attempt, 'reason': 'failed'}
+            else: st.session_state.company_search_failure = {'attempt': attempt, 'reason': 'blocked'}
+        elif company_search is None:
+            if failure['reason'] == 'blocked': st.warning("Агрегацію по компаніях не виконано: орієнтовний обсяг сканування перевищує ліміт. Звузьте фільтри.")
+            else: st.warning("Не вдалося агрегувати дані по компаніях.")
+            st.button("🔄 Повторити агрегацію", on_click=st.session_state.pop, args=('company_search_failure', None), key="retry_company_search")
+        if company_search is not None:
+            company_page = load_results_page(company_search, company_search['page_index'])
+            st.info(f"Відображено {company_search['total_rows'] if company_search['total_rows'] is not None else len(company_page.frame):,} унікальних компаній.".replace(',', ' '))
+            page_navigation('company_search', company_page.frame)
+            display_df = labelled_view(company_page, COMPANY_LABELS)
         else:
-            display_df = results_df
+            display_df = None
+    elif not page.frame.empty:
+        page_navigation('search', page.frame)
+        display_df = labelled_view(page, COLUMN_LABELS)
+    else:
+        display_df = None
             
+    if display_df is not None and not display_df.empty:
         st.dataframe(display_df)
+        export_controls('company_search' if show_unique else 'search')
 
-        excel_data = to_excel(display_df) 
-        st.download_button(
-            label="📥 Завантажити в форматі Excel",
-            data=excel_data,
-            file_name='customs_data_export.xlsx',
-            mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+    prefetch_next_page('company_search' if show_unique else 'search')
+
+st.divider()
+st.header("📈 Аналітика трендів")
+# Куб строится при первом открытии, поэтому блок включается явно
+if st.checkbox("Показати динаміку, топ партнерів і частки ринку", key="show_analytics"):
+    show_analytics()
+
+st.divider()
+show_query_diagnostics()
@@ -0,0 +1,270 @@
+# ===============================================
+# benchmark.py - Нагрузочный прогон путей запросов на локальном бэкенде
+# Фиксированная нагрузка (комбинации фильтров, позиции групп, проверка кодов AI,
+# уникальные компании, экспорт) воспроизводится на DuckDB поверх Parquet-снимка -
+# без сети и без BigQuery. Отчёт: перцентили задержек по местам вызова, пиковая
+# память процесса и пропускная способность по интервалам времени.
+#
+# Запуск:
+#   python benchmark.py data/synthetic --rows 1000000         - сгенерировать данные, если их нет, и прогнать
+#   python benchmark.py data/synthetic --rounds 5 --concurrency 4 --report bench.json
+# ===============================================
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from query_backend import DuckDBBackend
+from query_builder import EMPTY_FILTERS, COMPANY_SORTS, search_query, count_query, company_query, company_count_query, positions_query, code_validation_query
+from query_metrics import frame_stats, measure_query
+from filter_catalog import catalog_query, FilterCatalog
+from code_index import CodeIndex, code_index_query
+from company_index import CompanyIndex, company_index_query
+from export import export_to_tempfile
+
+# site - место вызова в отчёте, run(stats) выполняет операцию и дописывает в stats то, что знает
+Operation = namedtuple('Operation', ['site', 'run'])
+
+# --- ПАМЯТЬ ---
+
+def rss_bytes():
+    # Текущий RSS процесса (DuckDB выделяет память вне Python, поэтому tracemalloc не подходит)
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+class MemorySampler:
+    # Фоновый поток снимает RSS с заданным интервалом; пик - максимум по снимкам
+    def __init__(self, interval=0.05):
+        self.interval = interval; self.samples = []; self._stop = threading.Event(); self._started = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = rss_bytes()
+            if rss is not None: self.samples.append((time.perf_counter() - self._started, rss))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._started = time.perf_counter(); self._thread.start(); return self
+
+    def __exit__(self, *exc):
+        self._stop.set(); self._thread.join()
+
+    @property
+    def peak(self):
+        return max((rss for _, rss in self.samples), default=None)
+
+    def at(self, offset):
+        # RSS на момент offset секунд от начала прогона
+        current = None
+        for t, rss in self.samples:
+            if t > offset: break
+            current = rss
+        return current
+
+# --- НАГРУЗКА ---
+
+def filters(**values):
+    return {**EMPTY_FILTERS, **values}
+
+def query_operation(site, backend, query_and_params):
+    def run(stats):
+        df = backend.query(*query_and_params, stats=stats); stats.update(frame_stats(df))
+    return Operation(site, run)
+
+def search_operation(site, backend, query_and_params, total_and_params, pages=2, page_size=1000):
+    # Как поиск в интерфейсе: COUNT и первые страницы результата
+    def run(stats):
+        backend.query(*total_and_params)
+        token = None; rows = 0; df_bytes = 0
+        for page_index in range(pages):
+            df, token = backend.page(*query_and_params, token, page_size, stats=stats if page_index == 0 else None)
+            rows += len(df); df_bytes = max(df_bytes, frame_stats(df)['df_bytes'])
+            if token is None: break
+        stats.update(rows=rows, df_bytes=df_bytes)
+    return Operation(site, run)
+
+def export_operation(site, backend, query_and_params, fmt, max_rows, batch_size=20000):
+    def run(stats):
+        batches = backend.iter_batches(*query_and_params, batch_size=batch_size, stats=stats)
+        path, rows, _ = export_to_tempfile(batches, fmt, max_rows=max_rows)
+        stats['rows'] = rows; os.remove(path)
+    return Operation(site, run)
+
+def index_operation(site, run_index):
+    def run(stats):
+        result = run_index()
+        if isinstance(result, pd.DataFrame): stats.update(frame_stats(result))
+        elif result is not None: stats['rows'] = len(result)
+    return Operation(site, run)
+
+def build_workload(backend, catalog, code_index, company_index, export_max_rows=200000):
+    # Параметры нагрузки берутся из самих данных (самые частые страны, группы, коды, компании),
+    # поэтому одна и та же нагрузка осмысленна на любом объёме
+    dialect = backend.dialect
+    counts = catalog.options()['counts']
+    def top(dimension, n): return [k for k, _ in sorted(counts.get(dimension, {}).items(), key=lambda kv: -kv[1])[:n]]
+    countries = top('countries', 3); groups = top('groups', 3); years = sorted(catalog.options()['years'], reverse=True)
+    positions = [n.code for n in sorted(code_index.children(groups[:1], 4), key=lambda n: -n.declarations)[:2]]
+    popular_codes = [n.code for n in sorted(code_index.codes.values(), key=lambda n: -n.declarations)[:20]]
+    top_companies = sorted((c for c in company_index.companies if c.code), key=lambda c: -c.declarations)[:20]
+    company_term = top_companies[0].name.split()[-1][:5] if top_companies else 'ТОВ'
+    codes, names = company_index.resolve([company_term])
+    filter_sets = {
+        'country_year': filters(countries=countries[:1], years=years[:1]),
+        'group_import': filters(group_codes=groups[:1], directions=['Імпорт']),
+        'positions_quarter': filters(position_codes=positions, months=[1, 2, 3], available_years=years),
+        'uktzed_prefix': filters(uktzed=[popular_codes[0][:6]] if popular_codes else []),
+        'company_index': filters(companies=[company_term], company_match={'codes': codes, 'names': names}),
+        'company_like': filters(companies=[company_term]),
+        'weight_transport': filters(weight_from=1000, transports=['Море'], countries=countries),
+        'yedrpou': filters(yedrpou=[c.code for c in top_companies[:3]]),
+    }
+    workload = []
+    for name, f in filter_sets.items():
+        workload.append(search_operation(f"filter_search:{name}", backend, search_query(f, dialect), count_query(f, dialect)))
+    for group in groups:
+        workload.append(query_operation('positions_sql', backend, positions_query([group], dialect)))
+        workload.append(index_operation('positions_index', lambda group=group: code_index.positions([group])))
+    # Коды, как их предлагает AI: префиксы разной длины от реальных кодов и несуществующие коды
+    suggestions = [[c[:4], c[:6], c] for c in popular_codes[:3]] + [['0000', '9999999999']]
+    for codes_to_check in suggestions:
+        workload.append(query_operation('validation_sql', backend, code_validation_query(codes_to_check, dialect)))
+        workload.append(index_operation('validation_index', lambda codes_to_check=codes_to_check: code_index.validate(codes_to_check)))
+    workload.append(index_operation('company_autocomplete', lambda: company_index.autocomplete(company_term[:3], limit=15)))
+    for name in ('country_year', 'group_import'):
+        for sort_by in COMPANY_SORTS:
+            f = filter_sets[name]
+            workload.append(search_operation(f"unique_companies:{sort_by}", backend, company_query(f, dialect, sort_by), company_count_query(f, dialect), pages=1))
+    for fmt in ('csv', 'parquet'):
+        workload.append(export_operation(f"export_{fmt}", backend, search_query(filter_sets['group_import'], dialect), fmt, export_max_rows))
+    return workload
+
+# --- ПРОГОН ---
+
+def run_measured(operation, records, started, lock):
+    def on_record(stats):
+        stats['offset_s'] = round(time.perf_counter() - started, 3)
+        with lock: records.append(stats)
+    try:
+        with measure_query(operation.site, operation.site, backend='duckdb', on_record=on_record) as stats:
+            operation.run(stats)
+    except Exception:
+        pass  # ошибка уже записана в stats['error']
+
+def setup(backend):
+    # Холодный старт приложения: каталог фильтров и индексы; время каждого шага попадает в отчёт
+    records = []; result = {}
+    steps = (
+        ('filter_options', lambda: FilterCatalog().apply(backend.query(*catalog_query(backend.dialect)), now=time.time()), 'catalog'),
+        ('code_index', lambda: CodeIndex.from_frame(backend.query(*code_index_query(backend.dialect))), 'code_index'),
+        ('company_index', lambda: CompanyIndex.from_frame(backend.query(*company_index_query(backend.dialect))), 'company_index'),
+    )
+    for site, build, key in steps:
+        with measure_query(site, site, backend='duckdb', on_record=records.append) as stats:
+            result[key] = build()
+            if key != 'catalog': stats['rows'] = len(result[key])
+    return result, records
+
+def run_benchmark(backend, rounds=3, concurrency=1, seed=0, export_max_rows=200000, window=5.0):
+    prepared, setup_records = setup(backend)
+    workload = build_workload(backend, prepared['catalog'], prepared['code_index'], prepared['company_index'], export_max_rows)
+    rng = random.Random(seed); schedule = []
+    for _ in range(rounds):
+        round_ops = list(workload); rng.shuffle(round_ops); schedule.extend(round_ops)
+    records = []; lock = threading.Lock()
+    with MemorySampler() as memory:
+        started = time.perf_counter()
+        if concurrency <= 1:
+            for operation in schedule: run_measured(operation, records, started, lock)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(lambda op: run_measured(op, records, started, lock), schedule))
+        elapsed = time.perf_counter() - started
+    return {
+        'config': {'rounds': rounds, 'concurrency': concurrency, 'seed': seed, 'operations': len(schedule), 'export_max_rows': export_max_rows},
+        'elapsed_s': round(elapsed, 3), 'ops_per_s': round(len(schedule) / elapsed, 2) if elapsed else None,
+        'peak_rss_bytes': memory.peak,
+        'setup': setup_records, 'sites': site_summary(records).to_dict('records'),
+        'timeline': timeline(records, memory, window).to_dict('records'), 'records': records,
+    }
+
+# --- ОТЧЁТ ---
+
+def site_summary(records):
+    df = pd.DataFrame(records)
+    rows = []
+    for site, group in df.groupby('site'):
+        wall = group['wall_ms'].to_numpy(dtype=float)
+        first_row = pd.to_numeric(group['first_row_ms'], errors='coerce').dropna().to_numpy(dtype=float)
+        p50, p90, p99 = np.percentile(wall, [50, 90, 99])
+        rows.append({
+            'site': site, 'count': len(group), 'p50_ms': round(p50, 1), 'p90_ms': round(p90, 1), 'p99_ms': round(p99, 1),
+            'max_ms': round(wall.max(), 1), 'first_row_p50_ms': round(float(np.median(first_row)), 1) if len(first_row) else None,
+            'rows_avg': round(pd.to_numeric(group['rows'], errors='coerce').mean(), 1),
+            'df_bytes_max': pd.to_numeric(group['df_bytes'], errors='coerce').max(), 'errors': int(group['error'].notna().sum()),
+        })
+    return pd.DataFrame(rows).sort_values('p90_ms', ascending=False)
+
+def timeline(records, memory, window):
+    # Пропускная способность по интервалам: операции и строки в секунду, медиана задержки, RSS в конце интервала
+    df = pd.DataFrame(records)
+    df['window'] = (df['offset_s'] // window).astype(int)
+    result = []
+    for w, group in df.groupby('window'):
+        end = (w + 1) * window
+        result.append({
+            'from_s': w * window, 'to_s': end, 'ops': len(group), 'ops_per_s': round(len(group) / window, 2),
+            'rows_per_s': round(pd.to_numeric(group['rows'], errors='coerce').sum() / window, 1),
+            'p50_ms': round(float(group['wall_ms'].median()), 1), 'rss_bytes': memory.at(end),
+        })
+    return pd.DataFrame(result)
+
+def format_report(report):
+    peak = f"{report['peak_rss_bytes'] / 1024 ** 2:.0f} МБ" if report['peak_rss_bytes'] else "н/д"
+    lines = [
+        f"Операцій: {report['config']['operations']}, час: {report['elapsed_s']} с, {report['ops_per_s']} оп/с, пікова пам'ять: {peak}",
+        "", "Холодний старт:",
+        pd.DataFrame(report['setup'])[['site', 'wall_ms', 'rows']].to_string(index=False),
+        "", "Затримки за місцями виклику:", pd.DataFrame(report['sites']).to_string(index=False),
+        "", "Пропускна здатність у часі:", pd.DataFrame(report['timeline']).to_string(index=False),
+    ]
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Навантажувальний прогін запитів на локальному бекенді DuckDB")
+    parser.add_argument('data', help="каталог або файл Parquet з таблицею declarations")
+    parser.add_argument('--rows', type=int, help="згенерувати синтетичні дані такого обсягу, якщо каталогу немає")
+    parser.add_argument('--typed', action='store_true', help="дані типізовані (typed_table.py --local)")
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--export-max-rows', type=int, default=200000)
+    parser.add_argument('--window', type=float, default=5.0, help="інтервал для пропускної здатності, с")
+    parser.add_argument('--report', help="записати повний звіт у JSON")
+    args = parser.parse_args()
+    if not os.path.exists(args.data):
+        if not args.rows: parser.error(f"{args.data} не існує; вкажіть --rows, щоб згенерувати дані")
+        from synthetic_data import generate
+        generate(args.data, args.rows, seed=args.seed)
+    backend = DuckDBBackend(args.data, typed=args.typed)
+    report = run_benchmark(backend, rounds=args.rounds, concurrency=args.concurrency, seed=args.seed, export_max_rows=args.export_max_rows, window=args.window)
+    print(format_report(report))
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=1, default=str)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# ===============================================
+# code_index.py - Индекс иерархии кодов УКТЗЕД
+# Дерево префиксов (2/4/6/8 знаков) и полных кодов, встречающихся в данных,
+# с количеством деклараций, суммой стоимости и самым частым описанием товара.
+# Строится одним запросом после обновления данных и обслуживается из памяти:
+# выпадающий список позиций и проверка кодов AI становятся поиском по индексу.
+# ===============================================
+
+from bisect import bisect_left
+from collections import namedtuple
+import pandas as pd
+
+PREFIX_LENGTHS = (2, 4, 6, 8)
+CodeNode = namedtuple('CodeNode', ['code', 'declarations', 'total_value', 'valued', 'description'])
+
+def code_index_query(dialect):
+    # Один проход: GROUPING SETS по (уровень префикса, описание), затем выбор самого частого описания
+    prefix_columns = ", ".join(f"CASE WHEN LENGTH(kod_uktzed) >= {n} THEN SUBSTR(kod_uktzed, 1, {n}) END AS p{n}" for n in PREFIX_LENGTHS)
+    level_case = " ".join(f"WHEN GROUPING(p{n}) = 0 THEN 'p{n}'" for n in PREFIX_LENGTHS)
+    node_case = " ".join(f"WHEN GROUPING(p{n}) = 0 THEN p{n}" for n in PREFIX_LENGTHS)
+    grouping_sets = ", ".join(f"(p{n}, opis_tovaru)" for n in PREFIX_LENGTHS)
+    query = f"""
+    WITH Base AS (
+        SELECT kod_uktzed, opis_tovaru, {dialect.to_float('mytna_vartist_hrn')} AS customs_value, {prefix_columns}
+        FROM {dialect.table()} WHERE kod_uktzed IS NOT NULL AND LENGTH(kod_uktzed) >= 2
+    ),
+    NodeDescriptions AS (
+        SELECT CASE {level_case} ELSE 'code' END AS level,
+               CASE {node_case} ELSE kod_uktzed END AS node,
+               opis_tovaru, COUNT(*) AS declarations, SUM(customs_value) AS total_value, COUNT(customs_value) AS valued
+        FROM Base GROUP BY GROUPING SETS ({grouping_sets}, (kod_uktzed, opis_tovaru))
+    )
+    SELECT level, node, SUM(declarations) AS declarations, SUM(total_value) AS total_value, SUM(valued) AS valued,
+           {dialect.arg_max('opis_tovaru', 'declarations')} AS description
+    FROM NodeDescriptions WHERE node IS NOT NULL GROUP BY level, node
+    """
+    return query, []
+
+class CodeIndex:
+    def __init__(self, prefixes, codes):
+        self.prefixes = prefixes  # длина префикса -> {префикс: CodeNode}
+        self.codes = codes        # полный код -> CodeNode
+        self._sorted_codes = sorted(codes)
+
+    @classmethod
+    def from_frame(cls, df):
+        prefixes = {n: {} for n in PREFIX_LENGTHS}; codes = {}
+        for row in df.itertuples(index=False):
+            node = CodeNode(str(row.node), int(row.declarations), float(row.total_value) if pd.notna(row.total_value) else 0.0,
+                            int(row.valued) if pd.notna(row.valued) else 0, row.description if pd.notna(row.description) else None)
+            if row.level == 'code': codes[node.code] = node
+            else: prefixes[int(row.level[1:])][node.code] = node
+        return cls(prefixes, codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def codes_with_prefix(self, prefix):
+        # Полные коды, начинающиеся с prefix, - бинарный поиск по отсортированному списку
+        i = bisect_left(self._sorted_codes, prefix); result = []
+        while i < len(self._sorted_codes) and self._sorted_codes[i].startswith(prefix):
+            result.append(self.codes[self._sorted_codes[i]]); i += 1
+        return result
+
+    def children(self, parent_codes, length):
+        nodes = self.prefixes.get(length, {})
+        return sorted((node for code, node in nodes.items() if any(code.startswith(p) for p in parent_codes)), key=lambda n: n.code)
+
+    def positions(self, group_codes):
+        # Аналог positions_query: 4-значные позиции выбранных групп с самым частым описанием
+        nodes = self.children(group_codes, 4)
+        return pd.DataFrame({'pos_code': [n.code for n in nodes], 'pos_description': [n.description for n in nodes]})
+
+    def validate(self, codes, limit=50):
+        # Аналог code_validation_query: полные коды из базы, начинающиеся с любого из предложенных кодов
+        matched = {}
+        for prefix in codes:
+            for node in self.codes_with_prefix(prefix): matched[node.code] = node
+        nodes = sorted(matched.values(), key=lambda n: (-n.declarations, n.code))[:limit]
+        return pd.DataFrame({
+            'Код УКТЗЕД в базі': [n.code for n in nodes],
+            'Найчастіший опис в базі': [n.description for n in nodes],
+            'Кількість декларацій': [n.declarations for n in nodes],
+            'Загальна вартість грн': [n.total_value if n.valued else None for n in nodes],
+            'Середня вартість грн': [n.total_value / n.valued if n.valued else None for n in nodes],
+        })
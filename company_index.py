@@ -0,0 +1,107 @@
+# ===============================================
+# company_index.py - Триграммный индекс компаний
+# Частичное название (или часть кода ЄДРПОУ) превращается в точный набор кодов ЄДРПОУ,
+# и основной запрос фильтрует kod_yedrpou IN UNNEST(...) вместо UPPER(nazva_kompanii) LIKE '%X%'
+# по всей таблице. Этот же индекс даёт подсказки при вводе названия.
+# ===============================================
+
+from collections import defaultdict, namedtuple
+import pandas as pd
+
+# names - нормализованные варианты названия, raw_names - как в таблице (для точного сравнения в SQL)
+Company = namedtuple('Company', ['code', 'name', 'declarations', 'names', 'raw_names'])
+
+def company_index_query(dialect):
+    query = f"""
+    SELECT kod_yedrpou, nazva_kompanii, COUNT(*) AS declarations
+    FROM {dialect.table()} WHERE nazva_kompanii IS NOT NULL OR kod_yedrpou IS NOT NULL
+    GROUP BY kod_yedrpou, nazva_kompanii
+    """
+    return query, []
+
+def normalize_name(text):
+    # Та же нормализация, что и UPPER(...) LIKE в SQL, плюс схлопывание пробелов
+    return " ".join(str(text).upper().split())
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class CompanyIndex:
+    def __init__(self, rows):
+        # rows: (kod_yedrpou, nazva_kompanii, declarations). Компания - код ЄДРПОУ со всеми вариантами
+        # названия; каноническое название - самое частое. Строки без кода индексируются по названию.
+        grouped = defaultdict(lambda: defaultdict(int))
+        for code, name, declarations in rows:
+            code = None if pd.isna(code) else str(code)
+            name = None if pd.isna(name) else str(name)
+            grouped[code if code is not None else ('', name)][name] += int(declarations)
+        self.companies = []; self.by_code = {}
+        postings = defaultdict(list)
+        for key, names in grouped.items():
+            code = key if isinstance(key, str) else None
+            raw_names = tuple(n for n in names if n)
+            variants = tuple(dict.fromkeys(normalize_name(n) for n in raw_names))
+            canonical = normalize_name(max(raw_names, key=lambda n: names[n])) if raw_names else ''
+            company = Company(code, canonical, sum(names.values()), variants, raw_names)
+            company_id = len(self.companies); self.companies.append(company)
+            if code is not None: self.by_code[code] = company
+            grams = set()
+            for text in variants + ((code,) if code else ()): grams |= trigrams(text)
+            for gram in grams: postings[gram].append(company_id)
+        self.postings = dict(postings)
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls(df[['kod_yedrpou', 'nazva_kompanii', 'declarations']].itertuples(index=False, name=None))
+
+    def __len__(self):
+        return len(self.companies)
+
+    def _candidates(self, term):
+        grams = trigrams(term)
+        if not grams: return range(len(self.companies))  # короче 3 символов - полный перебор
+        lists = sorted((self.postings.get(g, []) for g in grams), key=len)
+        if not lists[0]: return []
+        result = set(lists[0])
+        for ids in lists[1:]:
+            result &= set(ids)
+            if not result: break
+        return result
+
+    def find(self, term, include_code=False):
+        # Точная семантика UPPER(nazva_kompanii) LIKE '%term%': компании, у которых хотя бы один
+        # вариант названия (или, с include_code, код ЄДРПОУ) содержит term
+        term = normalize_name(term)
+        if not term: return []
+        found = []
+        for company_id in self._candidates(term):
+            company = self.companies[company_id]
+            if any(term in n for n in company.names) or (include_code and company.code and term in company.code): found.append(company)
+        return found
+
+    def resolve(self, terms):
+        # -> (коды ЄДРПОУ, названия компаний без кода) для условия фильтра
+        codes = set(); names = set()
+        for term in terms:
+            for company in self.find(term):
+                if company.code is not None: codes.add(company.code)
+                else: names.update(company.raw_names)
+        return sorted(codes), sorted(names)
+
+    def autocomplete(self, text, limit=10, min_similarity=0.5):
+        # Сначала подстрочные совпадения (начало названия выше), затем нечёткие по доле общих триграмм
+        term = normalize_name(text)
+        if not term: return []
+        exact = sorted(self.find(term, include_code=True), key=lambda c: (not c.name.startswith(term), -c.declarations, c.name))[:limit]
+        grams = trigrams(term)
+        if len(exact) >= limit or not grams: return exact
+        overlap = defaultdict(int)
+        for gram in grams:
+            for company_id in self.postings.get(gram, []): overlap[company_id] += 1
+        seen = {id(c) for c in exact}
+        fuzzy = [
+            (count / len(grams), self.companies[company_id]) for company_id, count in overlap.items()
+            if count / len(grams) >= min_similarity and id(self.companies[company_id]) not in seen
+        ]
+        fuzzy.sort(key=lambda item: (-item[0], -item[1].declarations, item[1].name))
+        return exact + [company for _, company in fuzzy[:limit - len(exact)]]
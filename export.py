@@ -0,0 +1,129 @@
+# ===============================================
+# export.py - Потоковый экспорт результатов (XLSX / CSV / Parquet)
+# Строки приходят Arrow-батчами из backend.iter_batches и сразу пишутся в файл
+# на диске, поэтому потребление памяти не зависит от размера выгрузки.
+# ===============================================
+
+import os
+import tempfile
+import time
+import pyarrow as pa
+
+EXPORT_FORMATS = {
+    'xlsx': {'label': 'Excel (XLSX)', 'suffix': '.xlsx', 'mime': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
+    'csv': {'label': 'CSV', 'suffix': '.csv', 'mime': 'text/csv'},
+    'parquet': {'label': 'Parquet', 'suffix': '.parquet', 'mime': 'application/vnd.apache.parquet'},
+}
+EXPORT_PREFIX = 'customs_export_'
+# Ограничение листа Excel - 1 048 576 строк вместе с заголовком; дальше начинается новый лист
+XLSX_MAX_SHEET_ROWS = 1048575
+
+def relabel(batch, labels):
+    names = [labels.get(name, name) for name in batch.schema.names]
+    return pa.RecordBatch.from_arrays(batch.columns, names=names)
+
+class XlsxExportWriter:
+    # openpyxl в режиме write_only пишет строки в поток, не держа книгу в памяти
+    def __init__(self, path, columns):
+        from openpyxl import Workbook
+        self.path = path; self.columns = columns
+        self.workbook = Workbook(write_only=True)
+        self.sheet = None; self.sheet_rows = 0; self.sheet_count = 0
+
+    def _new_sheet(self):
+        self.sheet_count += 1
+        self.sheet = self.workbook.create_sheet(title='Data' if self.sheet_count == 1 else f'Data_{self.sheet_count}')
+        self.sheet.append(self.columns); self.sheet_rows = 0
+
+    def write_batch(self, batch):
+        if self.sheet is None: self._new_sheet()
+        for row in zip(*(column.to_pylist() for column in batch.columns)):
+            if self.sheet_rows >= XLSX_MAX_SHEET_ROWS: self._new_sheet()
+            self.sheet.append(row); self.sheet_rows += 1
+
+    def close(self):
+        if self.sheet is None: self._new_sheet()
+        self.workbook.save(self.path)
+
+class CsvExportWriter:
+    def __init__(self, path, columns):
+        self.path = path; self.columns = columns; self.writer = None
+        # BOM - чтобы Excel открывал UTF-8 с кириллицей без искажений
+        self.sink = open(path, 'wb'); self.sink.write(b'\xef\xbb\xbf')
+
+    def write_batch(self, batch):
+        import pyarrow.csv as pa_csv
+        if self.writer is None: self.writer = pa_csv.CSVWriter(self.sink, batch.schema)
+        self.writer.write_batch(batch)
+
+    def close(self):
+        if self.writer is not None: self.writer.close()
+        else:
+            import csv, io
+            header = io.StringIO(); csv.writer(header).writerow(self.columns)
+            self.sink.write(header.getvalue().encode('utf-8'))
+        self.sink.close()
+
+class ParquetExportWriter:
+    def __init__(self, path, columns):
+        self.path = path; self.columns = columns; self.writer = None
+
+    def write_batch(self, batch):
+        import pyarrow.parquet as pq
+        if self.writer is None: self.writer = pq.ParquetWriter(self.path, batch.schema)
+        self.writer.write_batch(batch)
+
+    def close(self):
+        if self.writer is not None: self.writer.close()
+        else:
+            import pyarrow.parquet as pq
+            pq.write_table(pa.table({name: pa.array([], pa.string()) for name in self.columns}), self.path)
+
+EXPORT_WRITERS = {'xlsx': XlsxExportWriter, 'csv': CsvExportWriter, 'parquet': ParquetExportWriter}
+
+def export_batches(batches, fmt, path, labels=None, columns=None, max_rows=None):
+    # Возвращает (количество строк, обрезан ли результат по max_rows)
+    labels = labels or {}
+    writer = EXPORT_WRITERS[fmt](path, [labels.get(c, c) for c in columns or []])
+    rows = 0; truncated = False
+    try:
+        for batch in batches:
+            if max_rows is not None and rows + batch.num_rows > max_rows:
+                batch = batch.slice(0, max_rows - rows); truncated = True
+            if batch.num_rows: writer.write_batch(relabel(batch, labels)); rows += batch.num_rows
+            if truncated: break
+    finally:
+        writer.close()
+        # Прерванный генератор батчей закрываем явно - бэкенд освобождает курсор / поток чтения
+        if hasattr(batches, 'close'): batches.close()
+    return rows, truncated
+
+def export_to_tempfile(batches, fmt, labels=None, columns=None, max_rows=None):
+    fd, path = tempfile.mkstemp(prefix=EXPORT_PREFIX, suffix=EXPORT_FORMATS[fmt]['suffix'])
+    os.close(fd)
+    try:
+        rows, truncated = export_batches(batches, fmt, path, labels=labels, columns=columns, max_rows=max_rows)
+    except Exception:
+        os.remove(path); raise
+    return path, rows, truncated
+
+def read_export_file(path):
+    # Содержимое читается только по нажатию кнопки скачивания, а не при каждой перерисовке
+    with open(path, 'rb') as f: return f.read()
+
+def cleanup_exports(max_age, directory=None, now=None):
+    # Файлы сессий, которые просто закрылись, никто не удаляет - чистим по возрасту
+    # (на Cloud Run /tmp живёт в памяти экземпляра). Возвращает число удалённых файлов.
+    directory = directory or tempfile.gettempdir(); now = time.time() if now is None else now
+    removed = 0
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return 0
+    for entry in entries:
+        if not entry.name.startswith(EXPORT_PREFIX) or not entry.is_file(): continue
+        try:
+            if now - entry.stat().st_mtime > max_age: os.remove(entry.path); removed += 1
+        except OSError:
+            pass  # файл уже удалён другой сессией
+    return removed
@@ -0,0 +1,149 @@
+# ===============================================
+# filter_catalog.py - Каталог значений для ручных фильтров
+# Один проход по таблице (GROUPING SETS) вместо пяти SELECT DISTINCT,
+# хранение на диске и инкрементальное обновление по дате декларации
+# ===============================================
+
+import json
+import os
+import time
+from datetime import date
+import pandas as pd
+from query_backend import QueryParam
+
+CATALOG_VERSION = 1
+DIMENSIONS = ['countries', 'transport', 'years', 'months', 'groups']
+# Колонка результата запроса, из которой берётся значение для каждого измерения
+DIMENSION_COLUMNS = {'countries': 'kraina_partner', 'transport': 'vyd_transportu', 'years': 'year', 'months': 'month', 'groups': 'group_code'}
+INT_DIMENSIONS = ('years', 'months')
+
+def catalog_query(dialect, since=None):
+    # since - дата последней загруженной декларации: инкрементальный проход читает только её и более новые.
+    # Строки за саму дату since пересчитываются заново (день мог догрузиться), поэтому в каталоге
+    # отдельно хранится вклад этого дня (boundary) и вычитается перед слиянием.
+    # Экономия только на типизированной партиционированной таблице: над строковой датой условие
+    # SAFE_CAST(...) >= @since ничего не отсекает, и проход тарифицируется как полный.
+    query_params = []; where_clause = ""
+    decl_date = dialect.to_date('data_deklaracii')
+    if since is not None:
+        where_clause = f"WHERE {decl_date} >= {dialect.param('since')}"
+        query_params.append(QueryParam("since", "DATE", since))
+    query = f"""
+    WITH Base AS (
+        SELECT kraina_partner, vyd_transportu, {decl_date} AS decl_date,
+               EXTRACT(YEAR FROM {decl_date}) AS year, EXTRACT(MONTH FROM {decl_date}) AS month,
+               CASE WHEN LENGTH(kod_uktzed) >= 2 THEN SUBSTR(kod_uktzed, 1, 2) END AS group_code
+        FROM {dialect.table()} {where_clause}
+    ),
+    MaxDate AS (SELECT MAX(decl_date) AS max_date FROM Base)
+    SELECT
+        CASE WHEN GROUPING(kraina_partner) = 0 THEN 'countries' WHEN GROUPING(vyd_transportu) = 0 THEN 'transport'
+             WHEN GROUPING(year) = 0 THEN 'years' WHEN GROUPING(month) = 0 THEN 'months' ELSE 'groups' END AS dimension,
+        kraina_partner, vyd_transportu, year, month, group_code,
+        COUNT(*) AS row_count,
+        SUM(CASE WHEN b.decl_date = m.max_date THEN 1 ELSE 0 END) AS boundary_count,
+        MAX(m.max_date) AS max_date
+    FROM Base b CROSS JOIN MaxDate m
+    GROUP BY GROUPING SETS ((kraina_partner), (vyd_transportu), (year), (month), (group_code))
+    """
+    return query, query_params
+
+class FilterCatalog:
+    def __init__(self):
+        self.counts = {dim: {} for dim in DIMENSIONS}
+        self.boundary = {dim: {} for dim in DIMENSIONS}
+        self.watermark = None
+        self.built_at = 0.0
+        self.full_built_at = 0.0
+
+    def is_empty(self):
+        return not any(self.counts.values())
+
+    def apply(self, df, incremental=False, now=None):
+        # df - результат catalog_query; при полном проходе каталог строится заново
+        now = time.time() if now is None else now
+        if not incremental:
+            self.counts = {dim: {} for dim in DIMENSIONS}; self.boundary = {dim: {} for dim in DIMENSIONS}
+            self.watermark = None; self.full_built_at = now
+        self.built_at = now
+        if df is None or df.empty: return self
+        for dim in DIMENSIONS:
+            for value, n in self.boundary[dim].items():
+                remaining = self.counts[dim].get(value, 0) - n
+                if remaining > 0: self.counts[dim][value] = remaining
+                else: self.counts[dim].pop(value, None)
+        self.boundary = {dim: {} for dim in DIMENSIONS}
+        for row in df.itertuples(index=False):
+            dim = row.dimension; value = getattr(row, DIMENSION_COLUMNS[dim])
+            if pd.isna(value): continue
+            if dim in INT_DIMENSIONS: value = int(value)
+            self.counts[dim][value] = self.counts[dim].get(value, 0) + int(row.row_count)
+            if row.boundary_count: self.boundary[dim][value] = int(row.boundary_count)
+        max_dates = df['max_date'].dropna()
+        if not max_dates.empty: self.watermark = as_date(max_dates.max())
+        return self
+
+    def options(self):
+        return {
+            'direction': ['Імпорт', 'Експорт'],
+            'countries': sorted(self.counts['countries']),
+            'transport': sorted(self.counts['transport']),
+            'years': sorted(self.counts['years'], reverse=True),
+            'months': sorted(self.counts['months']),
+            'groups': sorted(self.counts['groups']),
+            'counts': {dim: dict(values) for dim, values in self.counts.items()},
+        }
+
+    # --- ХРАНЕНИЕ НА ДИСКЕ ---
+
+    def to_dict(self):
+        return {
+            'version': CATALOG_VERSION, 'watermark': self.watermark.isoformat() if self.watermark else None,
+            'built_at': self.built_at, 'full_built_at': self.full_built_at,
+            'counts': {dim: [[v, n] for v, n in values.items()] for dim, values in self.counts.items()},
+            'boundary': {dim: [[v, n] for v, n in values.items()] for dim, values in self.boundary.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        catalog = cls()
+        if data.get('version') != CATALOG_VERSION: return catalog
+        catalog.watermark = date.fromisoformat(data['watermark']) if data.get('watermark') else None
+        catalog.built_at = data.get('built_at', 0.0); catalog.full_built_at = data.get('full_built_at', 0.0)
+        for dim in DIMENSIONS:
+            catalog.counts[dim] = {v: n for v, n in data.get('counts', {}).get(dim, [])}
+            catalog.boundary[dim] = {v: n for v, n in data.get('boundary', {}).get(dim, [])}
+        return catalog
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, encoding='utf-8') as f: return cls.from_dict(json.load(f))
+        except (OSError, ValueError):
+            return cls()
+
+def as_date(value):
+    # datetime / pandas.Timestamp / date / строка ISO -> date
+    if callable(getattr(value, 'date', None)): return value.date()
+    if isinstance(value, date): return value
+    return date.fromisoformat(str(value)[:10])
+
+def refresh_catalog(path, run, dialect, max_age=3600, full_rebuild_age=7 * 86400, now=None):
+    # run(query, params) -> DataFrame. Свежий каталог с диска отдаётся без запросов к базе;
+    # устаревший догружается инкрементально, раз в full_rebuild_age строится заново
+    # (чтобы учесть декларации, загруженные задним числом). На нетипизированной таблице
+    # инкрементальный проход стоит столько же, сколько полный, - там каталог всегда строится заново.
+    now = time.time() if now is None else now
+    catalog = FilterCatalog.load(path)
+    if not catalog.is_empty() and now - catalog.built_at < max_age: return catalog
+    incremental = dialect.typed and not catalog.is_empty() and catalog.watermark is not None and now - catalog.full_built_at < full_rebuild_age
+    query, query_params = catalog_query(dialect, since=catalog.watermark if incremental else None)
+    catalog.apply(run(query, query_params), incremental=incremental, now=now)
+    if not catalog.is_empty(): catalog.save(path)
+    return catalog
@@ -0,0 +1,225 @@
+# ===============================================
+# query_backend.py - Бэкенды выполнения запросов
+# BigQuery (продакшн) и DuckDB поверх локальной Parquet-копии
+# ===============================================
+
+import base64
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+
+# --- ПАРАМЕТРЫ ЗАПРОСОВ ---
+# Нейтральное описание параметра: тип задаётся в терминах BigQuery (STRING, INT64, FLOAT64, DATE),
+# параметр считается массивом, если value - список или кортеж.
+QueryParam = namedtuple('QueryParam', ['name', 'type', 'value'])
+
+def is_array_param(param):
+    return isinstance(param.value, (list, tuple))
+
+# --- ТОКЕНЫ СТРАНИЦ ---
+# Токен - непрозрачная строка с состоянием постраничного чтения конкретного запроса.
+# В него вшит отпечаток SQL и параметров, чтобы токен от другого запроса не был принят.
+
+def query_fingerprint(sql, params=None):
+    frozen = sorted((p.name, p.type, repr(p.value)) for p in params or [])
+    return hashlib.sha1(f"{sql}|{frozen}".encode('utf-8')).hexdigest()[:16]
+
+def encode_page_token(state, sql, params=None):
+    payload = json.dumps({**state, 'fp': query_fingerprint(sql, params)})
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_page_token(token, sql, params=None):
+    state = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    if state.pop('fp', None) != query_fingerprint(sql, params):
+        raise ValueError("Токен сторінки не відповідає запиту")
+    return state
+
+# --- ДИАЛЕКТЫ SQL ---
+# Один и тот же построитель запросов (query_builder.py) работает с обоими движками,
+# всё движково-специфичное собрано здесь.
+# typed=True - запросы идут к типизированной копии (typed_table.py): дата и числа уже имеют
+# нужный тип, и приведения к ним опускаются, чтобы работало отсечение партиций и кластеров.
+
+TYPED_COLUMNS = ('data_deklaracii', 'mytna_vartist_hrn', 'vaha_netto_kg')
+
+class SqlDialect:
+    name = None
+    typed = False
+    def is_typed(self, expr): return self.typed and expr in TYPED_COLUMNS
+    def table(self): raise NotImplementedError
+    def param(self, name): raise NotImplementedError
+    def ident(self, alias): raise NotImplementedError
+    def starts_with(self, column, param_name): return f"starts_with({column}, {self.param(param_name)})"
+    def in_list(self, column, param_name): raise NotImplementedError
+    def to_float(self, expr): raise NotImplementedError
+    def to_date(self, expr): raise NotImplementedError
+    def arg_max(self, expr, order_expr): raise NotImplementedError
+
+class BigQueryDialect(SqlDialect):
+    name = 'bigquery'
+    def __init__(self, table_id, typed=False): self.table_id = table_id; self.typed = typed
+    def table(self): return f"`{self.table_id}`"
+    def param(self, name): return f"@{name}"
+    def ident(self, alias): return f"`{alias}`"
+    def starts_with(self, column, param_name): return f"STARTS_WITH({column}, @{param_name})"
+    def in_list(self, column, param_name): return f"{column} IN UNNEST(@{param_name})"
+    def to_float(self, expr): return expr if self.is_typed(expr) else f"SAFE_CAST({expr} AS FLOAT64)"
+    def to_date(self, expr): return expr if self.is_typed(expr) else f"SAFE_CAST({expr} AS DATE)"
+    def arg_max(self, expr, order_expr): return f"ARRAY_AGG({expr} IGNORE NULLS ORDER BY {order_expr} DESC LIMIT 1)[SAFE_OFFSET(0)]"
+
+class DuckDBDialect(SqlDialect):
+    name = 'duckdb'
+    def __init__(self, table_name='declarations', typed=False): self.table_name = table_name; self.typed = typed
+    def table(self): return self.table_name
+    def param(self, name): return f"${name}"
+    def ident(self, alias): return f'"{alias}"'
+    def in_list(self, column, param_name): return f"list_contains(${param_name}, {column})"
+    def to_float(self, expr): return expr if self.is_typed(expr) else f"TRY_CAST({expr} AS DOUBLE)"
+    def to_date(self, expr): return expr if self.is_typed(expr) else f"TRY_CAST({expr} AS DATE)"
+    def arg_max(self, expr, order_expr): return f"arg_max({expr}, {order_expr}) FILTER (WHERE {expr} IS NOT NULL)"
+
+# --- БЭКЕНДЫ ---
+# Методы выполнения принимают необязательный словарь stats (см. query_metrics.py) и дописывают в него
+# то, что знает только движок: время до первой строки, объём сканирования, попадание в кэш движка.
+# Необязательный handle (см. query_jobs.py) - задание, от имени которого идёт запрос: бэкенд регистрирует
+# в нём отмену на стороне движка (задание BigQuery, прерывание курсора DuckDB).
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+class BigQueryBackend:
+    def __init__(self, client, table_id, typed=False):
+        self.client = client
+        self.dialect = BigQueryDialect(table_id, typed=typed)
+
+    def job_config(self, params=None):
+        from google.cloud.bigquery import QueryJobConfig, ArrayQueryParameter, ScalarQueryParameter
+        query_params = []
+        for p in params or []:
+            if is_array_param(p): query_params.append(ArrayQueryParameter(p.name, p.type, list(p.value)))
+            else: query_params.append(ScalarQueryParameter(p.name, p.type, p.value))
+        return QueryJobConfig(query_parameters=query_params)
+
+    def _job_stats(self, job, stats, started):
+        if stats is None: return
+        stats.update(
+            first_row_ms=elapsed_ms(started), bytes_processed=job.total_bytes_processed,
+            bytes_billed=job.total_bytes_billed, job_id=job.job_id,
+        )
+        if job.cache_hit: stats.update(cache_hit=True, cache='bigquery')
+
+    def _start(self, sql, params=None, handle=None):
+        if handle is not None: handle.check()
+        job = self.client.query(sql, job_config=self.job_config(params))
+        if handle is not None: handle.on_cancel(job.cancel)
+        return job
+
+    def query(self, sql, params=None, stats=None, handle=None):
+        started = time.perf_counter()
+        job = self._start(sql, params, handle); rows = job.result()
+        self._job_stats(job, stats, started)
+        return rows.to_dataframe()
+
+    def dry_run(self, sql, params=None):
+        # Оценка объёма сканирования без выполнения запроса (dry run не тарифицируется)
+        job_config = self.job_config(params); job_config.dry_run = True; job_config.use_query_cache = False
+        return self.client.query(sql, job_config=job_config).total_bytes_processed
+
+    def page(self, sql, params=None, page_token=None, page_size=1000, stats=None, handle=None):
+        # Запрос выполняется один раз; следующие страницы читаются из его временной таблицы
+        # результатов (tabledata.list не тарифицируется), позиция хранится в токене.
+        if page_token is None:
+            started = time.perf_counter()
+            job = self._start(sql, params, handle); job.result()
+            self._job_stats(job, stats, started)
+            state = {'job_id': job.job_id, 'location': job.location, 'offset': 0}
+            destination = job.destination
+        else:
+            state = decode_page_token(page_token, sql, params)
+            destination = self.client.get_job(state['job_id'], location=state['location']).destination
+        if handle is not None: handle.check()
+        rows = self.client.list_rows(destination, start_index=state['offset'], max_results=page_size)
+        df = rows.to_dataframe()
+        next_offset = state['offset'] + len(df)
+        has_next = len(df) == page_size and (rows.total_rows is None or next_offset < rows.total_rows)
+        return df, encode_page_token({**state, 'offset': next_offset}, sql, params) if has_next else None
+
+    def iter_batches(self, sql, params=None, batch_size=10000, stats=None, handle=None):
+        # Потоковое чтение результата Arrow-батчами - память не растёт с размером результата
+        started = time.perf_counter()
+        job = self._start(sql, params, handle); rows = job.result(page_size=batch_size)
+        self._job_stats(job, stats, started)
+        yield from rows.to_arrow_iterable()
+
+    def table_version(self):
+        # Время последнего изменения таблицы - метаданные, запрос не тарифицируется
+        return self.client.get_table(self.dialect.table_id).modified
+
+class DuckDBBackend:
+    # Локальный снимок таблицы declarations: каталог с *.parquet или один файл.
+    def __init__(self, parquet_path, table_name='declarations', typed=False):
+        import duckdb
+        if os.path.isdir(parquet_path): source = os.path.join(parquet_path, '*.parquet')
+        elif os.path.exists(parquet_path): source = parquet_path
+        else:
+            raise FileNotFoundError(f"Локальна копія даних не знайдена: {parquet_path}")
+        self.parquet_path = parquet_path
+        self.dialect = DuckDBDialect(table_name, typed=typed)
+        self._con = duckdb.connect(database=':memory:')
+        self._con.execute(f"CREATE VIEW {table_name} AS SELECT * FROM read_parquet('{source}')")
+
+    def _execute(self, cursor, sql, params=None):
+        bound = {p.name: list(p.value) if is_array_param(p) else p.value for p in params or []}
+        return cursor.execute(sql, bound) if bound else cursor.execute(sql)
+
+    def _cursor(self, handle=None):
+        # Streamlit обслуживает сессии в разных потоках - у каждого запроса свой курсор
+        if handle is not None: handle.check()
+        cursor = self._con.cursor()
+        if handle is not None: handle.on_cancel(cursor.interrupt)
+        return cursor
+
+    def query(self, sql, params=None, stats=None, handle=None):
+        cursor = self._cursor(handle)
+        try:
+            started = time.perf_counter()
+            result = self._execute(cursor, sql, params)
+            if stats is not None: stats['first_row_ms'] = elapsed_ms(started)
+            return result.df()
+        finally:
+            cursor.close()
+
+    def dry_run(self, sql, params=None):
+        # Локальное сканирование ничего не стоит - оценки нет
+        return None
+
+    def page(self, sql, params=None, page_token=None, page_size=1000, stats=None, handle=None):
+        # Локально повторный запрос дешёв: страница = LIMIT/OFFSET поверх упорядоченного запроса
+        state = decode_page_token(page_token, sql, params) if page_token else {'offset': 0}
+        df = self.query(f"{sql} LIMIT {int(page_size) + 1} OFFSET {int(state['offset'])}", params, stats=stats, handle=handle)
+        if len(df) <= page_size: return df, None
+        next_state = {'offset': state['offset'] + page_size}
+        return df.iloc[:page_size], encode_page_token(next_state, sql, params)
+
+    def iter_batches(self, sql, params=None, batch_size=10000, stats=None, handle=None):
+        cursor = self._cursor(handle)
+        try:
+            started = time.perf_counter()
+            reader = self._execute(cursor, sql, params).fetch_record_batch(batch_size)
+            if stats is not None: stats['first_row_ms'] = elapsed_ms(started)
+            yield from reader
+        finally:
+            cursor.close()
+
+    def table_version(self):
+        if not os.path.isdir(self.parquet_path): return os.path.getmtime(self.parquet_path)
+        return max((entry.stat().st_mtime for entry in os.scandir(self.parquet_path) if entry.name.endswith('.parquet')), default=0.0)
+
+def create_backend(backend_name, table_id, bq_client_factory=None, parquet_path=None, typed=False):
+    if backend_name == 'duckdb':
+        return DuckDBBackend(parquet_path or os.path.join('data', 'declarations'), typed=typed)
+    if backend_name == 'bigquery':
+        return BigQueryBackend(bq_client_factory(), table_id, typed=typed)
+    raise ValueError(f"Невідомий бекенд запитів: {backend_name}")
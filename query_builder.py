@@ -0,0 +1,212 @@
+# ===============================================
+# query_builder.py - Построение SQL-запросов к таблице declarations
+# Все запросы строятся через диалект бэкенда (query_backend.py)
+# ===============================================
+
+from datetime import date
+from query_backend import QueryParam
+
+# Ключи словаря фильтров, который собирает интерфейс (см. collect_filters в app.py)
+EMPTY_FILTERS = {
+    'directions': [], 'countries': [], 'transports': [], 'years': [], 'months': [],
+    'weight_from': 0, 'weight_to': 0, 'group_codes': [], 'position_codes': [],
+    'uktzed': [], 'yedrpou': [], 'companies': [],
+    # Компании, разрешённые индексом (company_index.py) в точный набор: {'codes': [...], 'names': [...]};
+    # None - индекс недоступен или набор слишком велик, тогда фильтр по названию идёт через LIKE
+    'company_match': None,
+    # Все годы, присутствующие в данных: нужны, чтобы выбор одних месяцев тоже превратить в диапазоны дат
+    'available_years': [],
+}
+
+# Колонки, которые показываются в результатах поиска, и их подписи в интерфейсе
+COLUMN_LABELS = {
+    'data_deklaracii': 'Дата декларації', 'napryamok': 'Напрямок', 'nazva_kompanii': 'Назва компанії',
+    'kod_yedrpou': 'Код ЄДРПОУ', 'kraina_partner': 'Країна-партнер', 'kod_uktzed': 'Код УКТЗЕД',
+    'opis_tovaru': 'Опис товару', 'mytna_vartist_hrn': 'Митна вартість, грн', 'vaha_netto_kg': 'Вага нетто, кг',
+    'vyd_transportu': 'Вид транспорту'
+}
+DISPLAY_COLUMNS = list(COLUMN_LABELS)
+# Порядок строк результата: новые декларации первыми, остальные колонки - для детерминированности страниц
+RESULT_ORDER = "data_deklaracii DESC, " + ", ".join(c for c in DISPLAY_COLUMNS if c != 'data_deklaracii')
+
+# Режим "уникальные компании": агрегаты по kod_yedrpou над всем отфильтрованным набором
+COMPANY_LABELS = {
+    'kod_yedrpou': 'Код ЄДРПОУ', 'nazva_kompanii': 'Назва компанії', 'declarations': 'Кількість декларацій (у фільтрі)',
+    'total_value': 'Митна вартість, грн (сума)', 'total_weight': 'Вага нетто, кг (сума)',
+    'first_date': 'Перша декларація', 'last_date': 'Остання декларація', 'top_codes': 'Основні коди УКТЗЕД'
+}
+COMPANY_SORTS = {
+    'declarations': 'Кількість декларацій', 'total_value': 'Митна вартість', 'total_weight': 'Вага нетто', 'last_date': 'Остання декларація'
+}
+COMPANY_TOP_CODES = 3
+# Компания - код ЄДРПОУ, а у записей без кода - название (с префиксом, чтобы не совпасть с кодом):
+# иначе все такие записи сливаются в одну группу NULL под случайным названием
+COMPANY_KEY = "COALESCE(kod_yedrpou, CONCAT('~', nazva_kompanii))"
+
+def process_text_input(input_str):
+    return [item.strip() for item in (input_str or '').split(',') if item.strip()]
+
+def next_month(d):
+    return date(d.year + 1, 1, 1) if d.month == 12 else date(d.year, d.month + 1, 1)
+
+def month_ranges(years, months):
+    # Выбор годов/месяцев -> список полуинтервалов дат [начало, конец); соседние месяцы
+    # (в том числе декабрь и январь следующего года) склеиваются в один диапазон
+    months = sorted({int(m) for m in months}) or list(range(1, 13))
+    ranges = []
+    for start in sorted(date(int(y), m, 1) for y in set(years) for m in months):
+        end = next_month(start)
+        if ranges and ranges[-1][1] == start: ranges[-1] = (ranges[-1][0], end)
+        else: ranges.append((start, end))
+    return ranges
+
+def prefix_condition(dialect, column, prefixes, param_prefix, params):
+    # OR-цепочка starts_with по списку префиксов, параметры добавляются в params
+    conditions = []
+    for i, prefix in enumerate(prefixes):
+        param_name = f"{param_prefix}{i}"; conditions.append(dialect.starts_with(column, param_name))
+        params.append(QueryParam(param_name, "STRING", prefix))
+    return f"({' OR '.join(conditions)})"
+
+def build_filter_conditions(filters, dialect):
+    f = {**EMPTY_FILTERS, **filters}
+    query_parts = []; query_params = []
+    if f['directions']:
+        query_parts.append(dialect.in_list("napryamok", "directions")); query_params.append(QueryParam("directions", "STRING", f['directions']))
+    if f['countries']:
+        query_parts.append(dialect.in_list("kraina_partner", "countries")); query_params.append(QueryParam("countries", "STRING", f['countries']))
+    if f['transports']:
+        query_parts.append(dialect.in_list("vyd_transportu", "transports")); query_params.append(QueryParam("transports", "STRING", f['transports']))
+    # Годы и месяцы сравниваются с датой напрямую диапазонами - это позволяет отсечь партиции
+    years = f['years'] or (f['available_years'] if f['months'] else [])
+    decl_date = dialect.to_date('data_deklaracii')
+    if years:
+        conditions = []
+        for i, (date_from, date_to) in enumerate(month_ranges(years, f['months'])):
+            conditions.append(f"({decl_date} >= {dialect.param(f'date_from{i}')} AND {decl_date} < {dialect.param(f'date_to{i}')})")
+            query_params.append(QueryParam(f"date_from{i}", "DATE", date_from)); query_params.append(QueryParam(f"date_to{i}", "DATE", date_to))
+        if not f['years']:
+            # Годы взяты из каталога, а он может отставать (январь сразу после смены года) - даты после
+            # последнего известного года проверяются по месяцу без верхней границы, строки не теряются
+            conditions.append(f"({decl_date} >= {dialect.param('date_tail')} AND {dialect.in_list(f'EXTRACT(MONTH FROM {decl_date})', 'months')})")
+            query_params.append(QueryParam("date_tail", "DATE", date(max(int(y) for y in years) + 1, 1, 1)))
+            query_params.append(QueryParam("months", "INT64", [int(m) for m in f['months']]))
+        query_parts.append(f"({' OR '.join(conditions)})")
+    elif f['months']:
+        query_parts.append(dialect.in_list(f"EXTRACT(MONTH FROM {decl_date})", "months")); query_params.append(QueryParam("months", "INT64", [int(m) for m in f['months']]))
+    if f['weight_from'] > 0:
+        query_parts.append(f"{dialect.to_float('vaha_netto_kg')} >= {dialect.param('weight_from')}"); query_params.append(QueryParam("weight_from", "FLOAT64", float(f['weight_from'])))
+    if f['weight_to'] > 0 and f['weight_to'] >= f['weight_from']:
+        query_parts.append(f"{dialect.to_float('vaha_netto_kg')} <= {dialect.param('weight_to')}"); query_params.append(QueryParam("weight_to", "FLOAT64", float(f['weight_to'])))
+
+    # Позиции (4 цифры) уточняют группы (2 цифры), поэтому имеют приоритет
+    if f['position_codes']:
+        query_parts.append(prefix_condition(dialect, "kod_uktzed", f['position_codes'], "position", query_params))
+    elif f['group_codes']:
+        query_parts.append(prefix_condition(dialect, "kod_uktzed", f['group_codes'], "group", query_params))
+
+    if f['uktzed']:
+        conditions = []
+        for i, item in enumerate(f['uktzed']):
+            param_name = f"uktzed{i}"; conditions.append(f"kod_uktzed LIKE {dialect.param(param_name)}")
+            query_params.append(QueryParam(param_name, "STRING", f"{item}%"))
+        query_parts.append(f"({' OR '.join(conditions)})")
+    if f['yedrpou']:
+        query_parts.append(dialect.in_list("kod_yedrpou", "yedrpou")); query_params.append(QueryParam("yedrpou", "STRING", f['yedrpou']))
+    if f['company_match'] is not None:
+        conditions = []
+        if f['company_match']['codes']:
+            conditions.append(dialect.in_list("kod_yedrpou", "company_codes")); query_params.append(QueryParam("company_codes", "STRING", f['company_match']['codes']))
+        if f['company_match']['names']:
+            conditions.append(dialect.in_list("nazva_kompanii", "company_names")); query_params.append(QueryParam("company_names", "STRING", f['company_match']['names']))
+        query_parts.append(f"({' OR '.join(conditions)})" if conditions else "FALSE")
+    elif f['companies']:
+        conditions = []
+        for i, item in enumerate(f['companies']):
+            param_name = f"company{i}"; conditions.append(f"UPPER(nazva_kompanii) LIKE {dialect.param(param_name)}")
+            query_params.append(QueryParam(param_name, "STRING", f"%{item.upper()}%"))
+        query_parts.append(f"({' OR '.join(conditions)})")
+    return query_parts, query_params
+
+def filter_where(filters, dialect):
+    # Возвращает (None, []) если не выбран ни один фильтр
+    query_parts, query_params = build_filter_conditions(filters, dialect)
+    if not query_parts: return None, []
+    return " AND ".join(query_parts), query_params
+
+def search_query(filters, dialect):
+    # Только отображаемые колонки, стабильный порядок - запрос читается постранично (backend.page)
+    where_clause, query_params = filter_where(filters, dialect)
+    if where_clause is None: return None, []
+    return f"SELECT {', '.join(DISPLAY_COLUMNS)} FROM {dialect.table()} WHERE {where_clause} ORDER BY {RESULT_ORDER}", query_params
+
+def company_query(filters, dialect, sort_by='declarations'):
+    where_clause, query_params = filter_where(filters, dialect)
+    if where_clause is None: return None, []
+    if sort_by not in COMPANY_SORTS: raise ValueError(f"Невідоме сортування: {sort_by}")
+    decl_date = dialect.to_date('data_deklaracii')
+    query = f"""
+    WITH Filtered AS (
+        SELECT {COMPANY_KEY} AS company_key, kod_yedrpou, nazva_kompanii, kod_uktzed, {decl_date} AS decl_date,
+               {dialect.to_float('mytna_vartist_hrn')} AS customs_value, {dialect.to_float('vaha_netto_kg')} AS net_weight
+        FROM {dialect.table()} WHERE {where_clause}
+    ),
+    Companies AS (
+        SELECT company_key, MAX(kod_yedrpou) AS kod_yedrpou, {dialect.arg_max('nazva_kompanii', 'decl_date')} AS nazva_kompanii,
+               COUNT(*) AS declarations, SUM(customs_value) AS total_value, SUM(net_weight) AS total_weight,
+               MIN(decl_date) AS first_date, MAX(decl_date) AS last_date
+        FROM Filtered GROUP BY company_key
+    ),
+    RankedCodes AS (
+        SELECT company_key, kod_uktzed, COUNT(*) AS frequency,
+               ROW_NUMBER() OVER(PARTITION BY company_key ORDER BY COUNT(*) DESC, kod_uktzed) AS rn
+        FROM Filtered WHERE kod_uktzed IS NOT NULL GROUP BY company_key, kod_uktzed
+    ),
+    TopCodes AS (
+        SELECT company_key, STRING_AGG(kod_uktzed, ', ' ORDER BY frequency DESC, kod_uktzed) AS top_codes
+        FROM RankedCodes WHERE rn <= {COMPANY_TOP_CODES} GROUP BY company_key
+    )
+    SELECT c.kod_yedrpou, c.nazva_kompanii, c.declarations, c.total_value, c.total_weight, c.first_date, c.last_date, t.top_codes
+    FROM Companies c LEFT JOIN TopCodes t ON c.company_key = t.company_key
+    ORDER BY c.{sort_by} DESC, c.company_key
+    """
+    return query, query_params
+
+def company_count_query(filters, dialect):
+    where_clause, query_params = filter_where(filters, dialect)
+    if where_clause is None: return None, []
+    return f"SELECT COUNT(*) AS total_rows FROM (SELECT {COMPANY_KEY} AS company_key FROM {dialect.table()} WHERE {where_clause} GROUP BY company_key)", query_params
+
+def count_query(filters, dialect):
+    where_clause, query_params = filter_where(filters, dialect)
+    if where_clause is None: return None, []
+    return f"SELECT COUNT(*) AS total_rows FROM {dialect.table()} WHERE {where_clause}", query_params
+
+def positions_query(group_codes, dialect):
+    query_params = []
+    group_conditions = prefix_condition(dialect, "kod_uktzed", group_codes, "group", query_params)
+    query = f"""
+    WITH PositionCounts AS (
+        SELECT SUBSTR(kod_uktzed, 1, 4) AS pos_code, opis_tovaru, COUNT(*) AS frequency
+        FROM {dialect.table()} WHERE {group_conditions} AND LENGTH(kod_uktzed) >= 4 GROUP BY pos_code, opis_tovaru
+    ),
+    RankedPositions AS (
+        SELECT pos_code, opis_tovaru, ROW_NUMBER() OVER(PARTITION BY pos_code ORDER BY frequency DESC) AS rn
+        FROM PositionCounts
+    )
+    SELECT pos_code, opis_tovaru AS pos_description FROM RankedPositions WHERE rn = 1 ORDER BY pos_code
+    """
+    return query, query_params
+
+def code_validation_query(codes, dialect):
+    query_params = []
+    where_clause = prefix_condition(dialect, "kod_uktzed", codes, "code", query_params)
+    q = dialect.ident
+    query = f"""
+    WITH BaseData AS (SELECT kod_uktzed, opis_tovaru, {dialect.to_float('mytna_vartist_hrn')} as customs_value FROM {dialect.table()} WHERE {where_clause} AND kod_uktzed IS NOT NULL),
+    RankedDescriptions AS (SELECT kod_uktzed, opis_tovaru, ROW_NUMBER() OVER(PARTITION BY kod_uktzed ORDER BY COUNT(*) DESC) as rn FROM BaseData WHERE opis_tovaru IS NOT NULL GROUP BY kod_uktzed, opis_tovaru),
+    Aggregates AS (SELECT kod_uktzed, COUNT(*) as total_declarations, SUM(customs_value) as total_value, AVG(customs_value) as avg_value FROM BaseData GROUP BY kod_uktzed)
+    SELECT a.kod_uktzed AS {q('Код УКТЗЕД в базі')}, rd.opis_tovaru AS {q('Найчастіший опис в базі')}, a.total_declarations AS {q('Кількість декларацій')}, a.total_value AS {q('Загальна вартість грн')}, a.avg_value AS {q('Середня вартість грн')}
+    FROM Aggregates a JOIN RankedDescriptions rd ON a.kod_uktzed = rd.kod_uktzed WHERE rd.rn = 1 ORDER BY a.total_declarations DESC LIMIT 50
+    """
+    return query, query_params
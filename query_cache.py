@@ -0,0 +1,103 @@
+# ===============================================
+# query_cache.py - Общий для всех сессий кэш результатов запросов
+# Ключ - нормализованный SQL + отсортированные параметры, хранение в Arrow,
+# LRU-вытеснение по бюджету памяти, TTL и сброс при обновлении таблицы
+# ===============================================
+
+import re
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+import pyarrow as pa
+from query_backend import is_array_param
+
+# Строковые литералы и идентификаторы в кавычках не трогаем, пробелы вне них схлопываем
+_SQL_TOKEN_RE = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)|\s+")
+
+def normalize_sql(sql):
+    return _SQL_TOKEN_RE.sub(lambda m: m.group(1) or ' ', sql).strip()
+
+def cache_key(sql, params=None):
+    frozen = tuple(sorted(
+        (p.name, p.type, tuple(p.value) if is_array_param(p) else p.value) for p in params or []
+    ))
+    return normalize_sql(sql), frozen
+
+def arrow_frame(table):
+    # Arrow-таблица неизменяема: DataFrame поверх неё строится без копирования буферов
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+class QueryResultCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024, ttl=3600, version_check_interval=60, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> (arrow_table, nbytes, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._table_version = None
+        self._version_checked_at = None
+        self.hits = 0; self.misses = 0; self.evictions = 0; self.invalidations = 0
+
+    def sync_version(self, version_fn):
+        # version_fn() - отметка свежести таблицы (время последнего изменения). Вызывается не чаще
+        # version_check_interval; если таблица обновилась, весь кэш сбрасывается.
+        now = self.clock()
+        with self._lock:
+            if self._version_checked_at is not None and now - self._version_checked_at < self.version_check_interval: return
+            self._version_checked_at = now
+        try: version = version_fn()
+        except Exception: return
+        with self._lock:
+            if self._table_version is not None and version != self._table_version:
+                self._clear_locked(); self.invalidations += 1
+            self._table_version = version
+
+    @property
+    def table_version(self):
+        return self._table_version
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.clock() - entry[2] > self.ttl:
+                self._drop_locked(key); entry = None
+            if entry is None:
+                self.misses += 1; return None
+            self._entries.move_to_end(key); self.hits += 1
+            table = entry[0]
+        return arrow_frame(table)
+
+    def put(self, key, df):
+        # Возвращает кадр в том же виде, что и get: вызывающий код получает одинаковые типы
+        # колонок (ArrowDtype) независимо от того, был ли результат в кэше
+        try: table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowException, TypeError, ValueError): return df
+        nbytes = table.nbytes
+        if nbytes > self.max_bytes: return arrow_frame(table)
+        with self._lock:
+            if key in self._entries: self._drop_locked(key)
+            self._entries[key] = (table, nbytes, self.clock()); self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries)); self._drop_locked(oldest); self.evictions += 1
+        return arrow_frame(table)
+
+    def clear(self):
+        with self._lock: self._clear_locked()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions, 'invalidations': self.invalidations,
+            }
+
+    def _drop_locked(self, key):
+        _, nbytes, _ = self._entries.pop(key); self._bytes -= nbytes
+
+    def _clear_locked(self):
+        self._entries.clear(); self._bytes = 0
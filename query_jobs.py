@@ -0,0 +1,140 @@
+# ===============================================
+# query_jobs.py - Параллельное и отменяемое выполнение запросов
+# Независимые запросы (подсчёт и первая страница поиска, загрузка индекса кодов, запрос к модели)
+# выполняются в общем пуле потоков процесса. Задания сессии сгруппированы: новое задание группы
+# отменяет предыдущие (пользователь изменил фильтры или повторил поиск), отмена доходит до движка -
+# задание BigQuery отменяется, запрос DuckDB прерывается. Общие задания (shared) не принадлежат сессии:
+# один запрос на процесс, результат забирает первая сессия, которой он понадобился.
+# Функции заданий выполняются вне потока скрипта Streamlit - в них нельзя обращаться к st.*.
+# ===============================================
+
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait, FIRST_COMPLETED
+
+class JobCancelled(Exception):
+    pass
+
+class JobHandle:
+    # Задание пула: future, флаг отмены и обработчики отмены, зарегистрированные бэкендом.
+    # records - записи статистики запросов задания (см. query_metrics.py) для панели диагностики сессии.
+    def __init__(self, group, label=None):
+        self.group = group; self.label = label or group
+        self.future = None; self.cancelled = False
+        self.records = []; self.updates = []
+        self.submitted_at = time.monotonic()
+        self._on_cancel = []; self._lock = threading.Lock()
+
+    def on_cancel(self, callback):
+        with self._lock:
+            if not self.cancelled: self._on_cancel.append(callback); return
+        callback()
+
+    def check(self):
+        # Вызывается перед каждым обращением к движку: отменённое задание не запускает новых запросов
+        if self.cancelled: raise JobCancelled(self.label)
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled or (self.future is not None and self.future.done()): return False
+            self.cancelled = True; callbacks = self._on_cancel; self._on_cancel = []
+        if self.future is not None: self.future.cancel()
+        for callback in callbacks:
+            try: callback()
+            except Exception: pass  # задание могло завершиться между проверкой и отменой
+        return True
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def usable(self):
+        # Результат ещё будет или уже получен без ошибки - заданием можно воспользоваться вместо нового
+        if self.cancelled: return False
+        return not self.done() or self.future.exception() is None
+
+    def result(self, timeout=None):
+        try:
+            value = self.future.result(timeout)
+        except CancelledError:
+            raise JobCancelled(self.label) from None
+        except Exception:
+            if self.cancelled: raise JobCancelled(self.label) from None
+            raise
+        if self.cancelled: raise JobCancelled(self.label)
+        return value
+
+class QueryExecutor:
+    def __init__(self, max_workers=8, shared_ttl=900, clock=time.monotonic):
+        self.shared_ttl = shared_ttl; self.clock = clock
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='query-job')
+        self._jobs = defaultdict(list)  # session_id -> [JobHandle]
+        self._shared = {}  # key -> JobHandle
+        self._lock = threading.Lock()
+
+    def _start(self, group, fn, args, kwargs, label=None):
+        # fn(handle, *args, **kwargs)
+        handle = JobHandle(group, label)
+        def run():
+            handle.check()
+            return fn(handle, *args, **kwargs)
+        handle.future = self._pool.submit(run)
+        return handle
+
+    def submit(self, session_id, group, fn, *args, supersede=True, label=None, **kwargs):
+        # supersede=False - задание дополняет уже запущенные в группе (подсчёт и страница одного поиска)
+        if supersede: self.cancel(session_id, group)
+        handle = self._start(group, fn, args, kwargs, label)
+        with self._lock:
+            jobs = [job for job in self._jobs[session_id] if not job.done()]
+            jobs.append(handle); self._jobs[session_id] = jobs
+        return handle
+
+    def cancel(self, session_id, group=None):
+        with self._lock:
+            jobs = [job for job in self._jobs.get(session_id, []) if group is None or job.group == group]
+        return sum(job.cancel() for job in jobs)
+
+    def in_flight(self, session_id):
+        with self._lock:
+            jobs = [job for job in self._jobs.get(session_id, []) if not job.done()]
+            if jobs: self._jobs[session_id] = jobs
+            else: self._jobs.pop(session_id, None)
+        return jobs
+
+    def shared(self, key, fn, *args, label=None, **kwargs):
+        # Один запрос на процесс по ключу: повторный вызов возвращает уже запущенное (или готовое) задание
+        with self._lock:
+            now = self.clock()
+            for stale in [k for k, job in self._shared.items() if job.done() and now - job.submitted_at > self.shared_ttl]:
+                del self._shared[stale]
+            handle = self._shared.get(key)
+            if handle is None or not handle.usable():
+                handle = self._start('shared', fn, args, kwargs, label or str(key)); self._shared[key] = handle
+            return handle
+
+    def release(self, key):
+        # Результат общего задания забран (и закэширован вызывающим кодом) - ссылку можно отпустить
+        with self._lock: self._shared.pop(key, None)
+
+    def shutdown(self, cancel=True):
+        if cancel:
+            with self._lock: jobs = [job for session_jobs in self._jobs.values() for job in session_jobs] + list(self._shared.values())
+            for job in jobs: job.cancel()
+        self._pool.shutdown(wait=not cancel, cancel_futures=cancel)
+
+def wait_any(handles, timeout=None):
+    # Ждёт завершения хотя бы одного задания (или таймаута); возвращает незавершённые
+    futures = [handle.future for handle in handles if not handle.done()]
+    if futures: wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+    return [handle for handle in handles if not handle.done()]
+
+def checked(batches, handle):
+    # Потоковое чтение с проверкой отмены между батчами: результат BigQuery дочитывается
+    # уже после завершения задания движка, и отмена задания его не остановит
+    try:
+        for batch in batches:
+            handle.check()
+            yield batch
+    finally:
+        if hasattr(batches, 'close'): batches.close()
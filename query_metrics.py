@@ -0,0 +1,90 @@
+# ===============================================
+# query_metrics.py - Инструментирование запросов
+# Каждый запрос оставляет запись: место вызова, время выполнения и до первой строки,
+# объём сканирования / тарификации, попадание в кэш, число строк и память DataFrame.
+# Записи пишутся в ротируемый JSONL-журнал и показываются в панели диагностики.
+# ===============================================
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+import pandas as pd
+from query_backend import query_fingerprint
+
+STATS_LABELS = {
+    'ts': 'Час', 'site': 'Місце виклику', 'backend': 'Бекенд', 'wall_ms': 'Тривалість, мс',
+    'first_row_ms': 'До першого рядка, мс', 'bytes_processed': 'Оброблено, байт', 'bytes_billed': 'Тарифіковано, байт',
+    'cache_hit': 'Кеш', 'cache': 'Джерело кешу', 'rows': 'Рядків', 'df_bytes': "Пам'ять DataFrame, байт",
+    'query': 'Відбиток запиту', 'job_id': 'Job ID', 'error': 'Помилка',
+}
+NUMERIC_STATS = ('wall_ms', 'first_row_ms', 'bytes_processed', 'bytes_billed', 'rows', 'df_bytes')
+
+def new_stats(site, sql, params=None, backend=None):
+    return {
+        'ts': time.strftime('%Y-%m-%dT%H:%M:%S'), 'site': site, 'backend': backend,
+        'wall_ms': None, 'first_row_ms': None, 'bytes_processed': None, 'bytes_billed': None,
+        'cache_hit': False, 'cache': None, 'rows': None, 'df_bytes': None,
+        'query': query_fingerprint(sql, params), 'job_id': None, 'error': None,
+    }
+
+def frame_stats(df):
+    if df is None: return {}
+    return {'rows': len(df), 'df_bytes': int(df.memory_usage(deep=True).sum())}
+
+@contextmanager
+def measure_query(site, sql, params=None, backend=None, on_record=None):
+    # Тело блока дописывает в stats то, что знает (бэкенд - объём и кэш движка, вызывающий код - строки);
+    # время и ошибка фиксируются здесь, запись уходит в on_record и при исключении
+    stats = new_stats(site, sql, params, backend); started = time.perf_counter()
+    try:
+        yield stats
+    except Exception as e:
+        stats['error'] = f"{type(e).__name__}: {e}"; raise
+    finally:
+        stats['wall_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        if on_record is not None: on_record(stats)
+
+class QueryLog:
+    # Журнал процесса: JSONL с ротацией по размеру и последние записи в памяти
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5, keep=500):
+        self.path = path
+        self.recent = deque(maxlen=keep); self._lock = threading.Lock()
+        self._logger = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._logger = logging.getLogger(f"query_log.{os.path.abspath(path)}")
+            self._logger.setLevel(logging.INFO); self._logger.propagate = False
+            if not self._logger.handlers:
+                self._logger.addHandler(RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True))
+
+    def record(self, stats):
+        with self._lock: self.recent.append(stats)
+        if self._logger is not None: self._logger.info(json.dumps(stats, ensure_ascii=False, default=str))
+
+def stats_frame(records):
+    df = pd.DataFrame(list(records), columns=list(STATS_LABELS))
+    for column in NUMERIC_STATS: df[column] = pd.to_numeric(df[column], errors='coerce')
+    df['cache_hit'] = df['cache_hit'].fillna(False).astype(bool)
+    return df
+
+def summarize_stats(records):
+    # Сводка по местам вызова: где тратится время и байты
+    df = stats_frame(records)
+    return df.groupby('site').agg(
+        queries=('site', 'size'), wall_ms_p50=('wall_ms', 'median'), wall_ms_max=('wall_ms', 'max'),
+        first_row_ms_p50=('first_row_ms', 'median'), bytes_processed=('bytes_processed', lambda s: s.sum(min_count=1)),
+        bytes_billed=('bytes_billed', lambda s: s.sum(min_count=1)), cache_hits=('cache_hit', 'sum'), rows=('rows', 'sum'),
+        df_bytes_max=('df_bytes', 'max'), errors=('error', 'count'),
+    ).reset_index().sort_values('bytes_billed', ascending=False)
+
+def format_bytes(value):
+    if value is None or pd.isna(value): return "—"
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if abs(value) < 1024: return f"{value:,.1f} {unit}".replace(',', ' ')
+        value /= 1024
+    return f"{value:,.1f} ТБ".replace(',', ' ')
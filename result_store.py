@@ -0,0 +1,85 @@
+# ===============================================
+# result_store.py - Компактные страницы результатов и производные представления
+# Страница результата хранится один раз на процесс (а не копией в session_state каждой сессии)
+# в типизированном виде: страны, компании и коды - категории, суммы и вес - числа,
+# дата - дата, всё остальное - строки Arrow. Производные представления (подписи колонок
+# для таблицы и т.п.) строятся один раз на (результат, страница, представление).
+# Кадры из хранилища общие для сессий - их нельзя изменять на месте.
+# ===============================================
+
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+import pyarrow as pa
+from query_backend import query_fingerprint
+
+CATEGORY_COLUMNS = ('napryamok', 'kraina_partner', 'vyd_transportu', 'kod_uktzed', 'kod_yedrpou', 'nazva_kompanii')
+NUMERIC_COLUMNS = ('mytna_vartist_hrn', 'vaha_netto_kg', 'declarations', 'total_value', 'total_weight')
+DATE_COLUMNS = ('data_deklaracii', 'first_date', 'last_date')
+
+def result_id(sql, params=None, table_version=None):
+    # Один и тот же запрос к одной и той же версии таблицы - один результат для всех сессий
+    return f"{query_fingerprint(sql, params)}:{table_version}"
+
+def compact_frame(df):
+    columns = {}
+    for name in df.columns:
+        column = df[name]
+        if name in DATE_COLUMNS:
+            column = pd.to_datetime(column, errors='coerce', format='ISO8601').astype(pd.ArrowDtype(pa.date32()))
+        elif name in NUMERIC_COLUMNS:
+            column = pd.to_numeric(column, errors='coerce')
+            column = column.astype('int64[pyarrow]' if pd.api.types.is_integer_dtype(column) else 'float64[pyarrow]')
+        else:
+            column = column.astype('string[pyarrow]')
+            # Категория выгодна, когда значения повторяются (страницы деклараций); в сводке по компаниям
+            # код и название уникальны в каждой строке - там остаются строки Arrow
+            if name in CATEGORY_COLUMNS and column.nunique() * 2 <= len(column): column = column.astype('category')
+        columns[name] = column.reset_index(drop=True)
+    return pd.DataFrame(columns)
+
+def frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+class ResultPage:
+    # Страница результата: компактный кадр, токен следующей страницы и построенные из кадра представления.
+    # Представления вытесняются вместе со страницей; с copy-on-write pandas они делят буферы с кадром.
+    def __init__(self, frame, next_token=None):
+        self.frame = frame; self.next_token = next_token; self.views = {}
+        self.nbytes = frame_bytes(frame)
+
+    def view(self, options, build):
+        # options - хешируемое описание представления (например, ('labels', 'results'))
+        if options not in self.views: self.views[options] = build(self.frame)
+        return self.views[options]
+
+class ResultStore:
+    # LRU по бюджету памяти с TTL; размер значения передаёт вызывающий код
+    def __init__(self, max_bytes=128 * 1024 * 1024, ttl=3600, clock=time.monotonic):
+        self.max_bytes = max_bytes; self.ttl = ttl; self.clock = clock
+        self._entries = OrderedDict()  # key -> (value, nbytes, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            if self.clock() - entry[2] > self.ttl:
+                self._drop_locked(key); return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes: return
+        with self._lock:
+            if key in self._entries: self._drop_locked(key)
+            self._entries[key] = (value, nbytes, self.clock()); self._bytes += nbytes
+            while self._bytes > self.max_bytes: self._drop_locked(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock: return {'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+    def _drop_locked(self, key):
+        _, nbytes, _ = self._entries.pop(key); self._bytes -= nbytes
@@ -0,0 +1,188 @@
+# ===============================================
+# rollups.py - Свёртки (кубы) для аналитики трендов и долей
+# Агрегаты месяц × направление × страна × группа/позиция УКТЗЕД (2/4 знака) × вид транспорта
+# с количеством деклараций, стоимостью и весом. Строятся одним проходом по таблице,
+# хранятся на диске и догружаются помесячно; временные ряды, топ партнёров и доли рынка
+# считаются по кубу в памяти, без сканирования исходной таблицы.
+# ===============================================
+
+import json
+import os
+import time
+from datetime import date
+import pandas as pd
+from query_backend import QueryParam
+from filter_catalog import as_date
+
+ROLLUP_VERSION = 1
+DIMENSION_COLUMNS = ['year', 'month', 'direction', 'country', 'hs2', 'hs4', 'transport']
+METRIC_COLUMNS = ['declarations', 'total_value', 'total_weight']
+METRIC_LABELS = {'declarations': 'Кількість декларацій', 'total_value': 'Митна вартість, грн', 'total_weight': 'Вага нетто, кг'}
+OTHER_LABEL = 'Інші'
+
+def rollup_query(dialect, since=None):
+    # since - первый день месяца: инкрементальный проход пересчитывает этот месяц и более новые целиком
+    query_params = []; where_clause = ""
+    decl_date = dialect.to_date('data_deklaracii')
+    if since is not None:
+        where_clause = f"AND {decl_date} >= {dialect.param('since')}"
+        query_params.append(QueryParam("since", "DATE", since))
+    query = f"""
+    WITH Base AS (
+        SELECT {decl_date} AS decl_date, napryamok, kraina_partner, vyd_transportu,
+               CASE WHEN LENGTH(kod_uktzed) >= 2 THEN SUBSTR(kod_uktzed, 1, 2) END AS hs2,
+               CASE WHEN LENGTH(kod_uktzed) >= 4 THEN SUBSTR(kod_uktzed, 1, 4) END AS hs4,
+               {dialect.to_float('mytna_vartist_hrn')} AS customs_value, {dialect.to_float('vaha_netto_kg')} AS net_weight
+        FROM {dialect.table()} WHERE {decl_date} IS NOT NULL {where_clause}
+    )
+    SELECT EXTRACT(YEAR FROM decl_date) AS year, EXTRACT(MONTH FROM decl_date) AS month,
+           napryamok AS direction, kraina_partner AS country, hs2, hs4, vyd_transportu AS transport,
+           COUNT(*) AS declarations, SUM(customs_value) AS total_value, SUM(net_weight) AS total_weight,
+           MAX(decl_date) AS max_date
+    FROM Base
+    GROUP BY year, month, direction, country, hs2, hs4, transport
+    """
+    return query, query_params
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+class RollupCube:
+    def __init__(self, frame=None):
+        self.frame = normalize_frame(frame if frame is not None else pd.DataFrame(columns=DIMENSION_COLUMNS + METRIC_COLUMNS))
+        self.watermark = None  # последняя дата декларации в кубе
+        self.built_at = 0.0
+        self.full_built_at = 0.0
+
+    def is_empty(self):
+        return self.frame.empty
+
+    def apply(self, df, since=None, now=None):
+        # df - результат rollup_query; при since заменяются месяцы начиная с since, иначе куб строится заново
+        now = time.time() if now is None else now
+        self.built_at = now
+        if since is None: self.full_built_at = now
+        if df is None or df.empty:
+            if since is None: self.frame = normalize_frame(None); self.watermark = None
+            return self
+        max_dates = df['max_date'].dropna()
+        new_rows = normalize_frame(df.drop(columns=['max_date']))
+        if since is not None:
+            period = self.frame['year'].astype('int32') * 100 + self.frame['month']
+            kept = self.frame[period < since.year * 100 + since.month]
+            new_rows = pd.concat([kept, new_rows], ignore_index=True)
+        self.frame = normalize_frame(new_rows)
+        if not max_dates.empty: self.watermark = as_date(max_dates.max())
+        return self
+
+    # --- ХРАНЕНИЕ НА ДИСКЕ ---
+
+    def save(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        meta = {'version': ROLLUP_VERSION, 'watermark': self.watermark.isoformat() if self.watermark else None,
+                'built_at': self.built_at, 'full_built_at': self.full_built_at}
+        table = pa.Table.from_pandas(self.frame, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'rollup': json.dumps(meta).encode('utf-8')})
+        tmp_path = f"{path}.tmp"
+        pq.write_table(table, tmp_path); os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        import pyarrow.parquet as pq
+        try:
+            table = pq.read_table(path)
+            meta = json.loads(table.schema.metadata[b'rollup'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return cls()
+        if meta.get('version') != ROLLUP_VERSION: return cls()
+        cube = cls(table.to_pandas())
+        cube.watermark = date.fromisoformat(meta['watermark']) if meta.get('watermark') else None
+        cube.built_at = meta.get('built_at', 0.0); cube.full_built_at = meta.get('full_built_at', 0.0)
+        return cube
+
+    # --- ВЫБОРКИ ДЛЯ АНАЛИТИКИ ---
+
+    def options(self):
+        return {
+            'directions': sorted(self.frame['direction'].dropna().unique()),
+            'countries': sorted(self.frame['country'].dropna().unique()),
+            'transports': sorted(self.frame['transport'].dropna().unique()),
+            'years': sorted(self.frame['year'].unique().tolist(), reverse=True),
+        }
+
+    def select(self, directions=None, countries=None, hs_codes=None, transports=None, years=None):
+        # hs_codes - коды групп (2 знака) и/или позиций (4 знака); пустой список - без ограничения
+        df = self.frame; mask = pd.Series(True, index=df.index)
+        if directions: mask &= df['direction'].isin(directions)
+        if countries: mask &= df['country'].isin(countries)
+        if transports: mask &= df['transport'].isin(transports)
+        if years: mask &= df['year'].isin([int(y) for y in years])
+        if hs_codes:
+            groups = [c for c in hs_codes if len(c) == 2]; positions = [c for c in hs_codes if len(c) == 4]
+            mask &= df['hs2'].isin(groups) | df['hs4'].isin(positions)
+        return df[mask]
+
+    def time_series(self, metric='declarations', by=None, **selection):
+        # Помесячный ряд: строки - месяцы, колонки - значения измерения by (или одна колонка метрики)
+        return monthly(self.select(**selection), metric, by)
+
+    def top_partners(self, metric='declarations', n=10, **selection):
+        # Топ-N стран по метрике с долей от итога по выборке; остальные страны - одной строкой
+        df = self.select(**selection)
+        if df.empty: return pd.DataFrame(columns=['country', metric, 'share'])
+        totals = df.groupby('country', observed=True)[metric].sum().sort_values(ascending=False)
+        top = totals.head(n); rest = totals.iloc[n:].sum()
+        if len(totals) > n and rest: top = pd.concat([top, pd.Series({OTHER_LABEL: rest})])
+        result = top.rename(metric).rename_axis('country').reset_index()
+        grand_total = totals.sum()
+        result['share'] = result[metric] / grand_total if grand_total else 0.0
+        return result
+
+    def market_share(self, metric='declarations', n=5, **selection):
+        # Помесячные доли топ-N стран (за весь период выборки), остальные - OTHER_LABEL; сумма по строке = 1
+        by_country = monthly(self.select(**selection), metric, by='country')
+        if by_country.empty: return by_country
+        leaders = by_country.sum().nlargest(n).index
+        series = by_country[leaders].copy(); rest = by_country.drop(columns=leaders).sum(axis=1)
+        if rest.any(): series[OTHER_LABEL] = rest
+        totals = series.sum(axis=1)
+        return series.div(totals.where(totals != 0), axis=0).fillna(0.0)
+
+def monthly(df, metric, by=None):
+    # Агрегация по целым (год, месяц) и только потом - даты периода для уже свёрнутых строк
+    if df.empty: return pd.DataFrame()
+    grouped = df.groupby(['year', 'month'] + ([by] if by is not None else []), observed=True)[metric].sum()
+    if by is not None:
+        result = grouped.unstack(fill_value=0); result.columns = result.columns.astype(str)
+    else:
+        result = grouped.rename(METRIC_LABELS[metric]).to_frame()
+    periods = result.index.to_frame(index=False)
+    result.index = pd.DatetimeIndex(pd.to_datetime(periods.assign(day=1)[['year', 'month', 'day']]), name='period')
+    return result
+
+def normalize_frame(df):
+    # Компактное представление: измерения - категории, год и месяц - малые целые
+    if df is None: df = pd.DataFrame(columns=DIMENSION_COLUMNS + METRIC_COLUMNS)
+    df = df[DIMENSION_COLUMNS + METRIC_COLUMNS].copy()
+    df['year'] = pd.to_numeric(df['year']).astype('int16'); df['month'] = pd.to_numeric(df['month']).astype('int8')
+    for column in ('direction', 'country', 'hs2', 'hs4', 'transport'):
+        df[column] = df[column].astype('string').astype('category')
+    df['declarations'] = pd.to_numeric(df['declarations']).astype('int64')
+    for column in ('total_value', 'total_weight'): df[column] = pd.to_numeric(df[column]).astype('float64')
+    return df.reset_index(drop=True)
+
+def refresh_rollup(path, run, dialect, max_age=3600, full_rebuild_age=7 * 86400, now=None):
+    # run(query, params) -> DataFrame. Как и каталог фильтров: свежий куб - с диска, устаревший догружается
+    # с начала последнего месяца, раз в full_rebuild_age строится заново (декларации, внесённые задним числом).
+    # На нетипизированной таблице условие по дате ничего не отсекает - там куб всегда строится заново
+    now = time.time() if now is None else now
+    cube = RollupCube.load(path)
+    if not cube.is_empty() and now - cube.built_at < max_age: return cube
+    incremental = dialect.typed and not cube.is_empty() and cube.watermark is not None and now - cube.full_built_at < full_rebuild_age
+    since = month_start(cube.watermark) if incremental else None
+    query, query_params = rollup_query(dialect, since=since)
+    cube.apply(run(query, query_params), since=since, now=now)
+    if not cube.is_empty(): cube.save(path)
+    return cube
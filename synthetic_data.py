@@ -0,0 +1,175 @@
+# ===============================================
+# synthetic_data.py - Синтетическая таблица declarations
+# Данные той же схемы, что и в продакшене: дата и числа хранятся строками,
+# распределения кодов УКТЗЕД, стран и компаний - с тяжёлым хвостом (Zipf),
+# у части компаний несколько вариантов названия, встречаются пустые значения и строки без кода ЄДРПОУ.
+# Пишется порциями в каталог Parquet-файлов (part-00000.parquet, ...), поэтому
+# объём от 100 тыс. до 100 млн строк не упирается в память; результат читает DuckDBBackend.
+#
+# Запуск:
+#   python synthetic_data.py data/synthetic --rows 1000000
+#   python synthetic_data.py data/synthetic --rows 100000000 --chunk-rows 2000000
+# ===============================================
+
+import argparse
+import datetime
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+DEFAULT_CHUNK_ROWS = 1000000
+DIRECTIONS = (('Імпорт', 0.65), ('Експорт', 0.35))
+TRANSPORTS = (('Авто', 0.55), ('Море', 0.2), ('Залізниця', 0.15), ('Авіа', 0.07), ('Трубопровід', 0.02), ('Пошта', 0.01))
+# Порядок задаёт частоту: первые страны встречаются чаще (распределение Zipf)
+COUNTRIES = (
+    'CN', 'PL', 'DE', 'TR', 'US', 'IT', 'MD', 'RO', 'HU', 'SK', 'FR', 'NL', 'ES', 'IN', 'CZ', 'LT', 'BG', 'GB', 'KR', 'JP',
+    'AT', 'BE', 'EG', 'AE', 'IL', 'VN', 'TW', 'SA', 'GE', 'AZ', 'KZ', 'LV', 'EE', 'SE', 'DK', 'FI', 'NO', 'CH', 'PT', 'GR',
+    'BR', 'AR', 'CA', 'MX', 'ID', 'MY', 'TH', 'PK', 'BD', 'MA', 'TN', 'DZ', 'NG', 'ZA', 'AU', 'NZ', 'SG', 'HK', 'UZ', 'AM',
+)
+# Группы УКТЗЕД, отсортированные примерно по частоте во внешней торговле
+HS_GROUPS = (
+    '84', '85', '87', '39', '73', '94', '61', '62', '64', '90', '72', '40', '33', '30', '38', '48', '44', '10', '15', '12',
+    '27', '28', '29', '34', '63', '95', '96', '82', '83', '76', '70', '69', '68', '32', '21', '22', '20', '19', '18', '17',
+    '16', '09', '08', '07', '04', '03', '02', '01', '05', '06', '11', '13', '14', '23', '24', '25', '26', '31', '35', '36',
+    '37', '41', '42', '43', '45', '46', '47', '49', '50', '51', '52', '53', '54', '55', '56', '57', '58', '59', '60', '65',
+    '66', '67', '71', '74', '75', '78', '79', '80', '81', '86', '88', '89', '91', '92', '93', '97',
+)
+COMPANY_FORMS = ('ТОВ', 'ПП', 'ПрАТ', 'АТ', 'ФОП')
+COMPANY_ROOTS = (
+    'АГРО', 'ТЕХ', 'ТРАНС', 'БУД', 'ЕНЕРГО', 'ХІМ', 'ФАРМ', 'МЕТАЛ', 'ТОРГ', 'ІМПЕКС', 'ЛОГІСТИК', 'ОПТ', 'СТАЛЬ', 'ПРОМ',
+    'ІНВЕСТ', 'СЕРВІС', 'МЕД', 'ЕКО', 'ДНІПРО', 'КИЇВ', 'ЛЬВІВ', 'ОДЕСА', 'ХАРКІВ', 'ПОЛІС', 'СВІТ', 'ЗЕРНО', 'МАШ', 'ЕЛЕКТРО',
+)
+COMPANY_SUFFIXES = ('', '', '', ' УКРАЇНА', ' ГРУП', ' ПЛЮС', ' ТРЕЙД', ' ЛТД', ' КОМПАНІ', ' ЦЕНТР')
+PRODUCT_NOUNS = (
+    'деталі', 'обладнання', 'вироби', 'частини', 'прилади', 'матеріали', 'інструменти', 'комплектуючі', 'машини', 'засоби',
+    'продукти', 'препарати', 'тканини', 'контейнери', 'плити', 'труби', 'кабелі', 'насоси', 'фільтри', 'двигуни',
+)
+PRODUCT_QUALIFIERS = (
+    'пластмасові', 'сталеві', 'алюмінієві', 'електричні', 'побутові', 'промислові', 'медичні', 'харчові', 'для автомобілів',
+    'для сільського господарства', 'для будівництва', 'текстильні', 'скляні', 'гумові', 'дерев\'яні', 'хімічні', 'паперові',
+)
+
+def zipf_cdf(n, exponent=1.1):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return np.cumsum(weights / weights.sum())
+
+def weighted_cdf(pairs):
+    weights = np.array([w for _, w in pairs], dtype=float)
+    return np.cumsum(weights / weights.sum())
+
+def sample(rng, cdf, size):
+    return np.minimum(np.searchsorted(cdf, rng.random(size), side='right'), len(cdf) - 1)
+
+class SyntheticCatalog:
+    # Справочники, из которых собираются строки: коды с описаниями и ценой за кг, компании с вариантами названия.
+    # Строится из seed детерминированно - порции генерируются независимо и сходятся в одни и те же справочники.
+    def __init__(self, seed=0, companies=10000, codes=8000, start=datetime.date(2021, 1, 1), end=datetime.date(2025, 12, 31)):
+        rng = np.random.default_rng(seed)
+        self.start = start; self.days = (end - start).days + 1
+        # Даты - строками, как в исходной таблице; объём растёт к концу периода
+        self.dates = pa.array([(start + datetime.timedelta(days=d)).isoformat() for d in range(self.days)])
+        self.date_cdf = np.cumsum(np.linspace(1.0, 2.0, self.days) / np.linspace(1.0, 2.0, self.days).sum())
+        self._build_codes(rng, codes)
+        self._build_companies(rng, companies)
+        self.country_cdf = zipf_cdf(len(COUNTRIES), 1.2)
+        self.direction_cdf = weighted_cdf(DIRECTIONS); self.transport_cdf = weighted_cdf(TRANSPORTS)
+
+    def _build_codes(self, rng, count):
+        group_cdf = zipf_cdf(len(HS_GROUPS), 0.9); position_cdf = zipf_cdf(99, 1.0); codes = set()
+        while len(codes) < count:
+            group = HS_GROUPS[sample(rng, group_cdf, 1)[0]]
+            # Внутри группы несколько частых позиций и длинный хвост подсубпозиций
+            position = int(sample(rng, position_cdf, 1)[0]) + 1
+            codes.add(f"{group}{position:02d}{int(rng.integers(0, 1000000)):06d}")
+        codes = sorted(codes); order = rng.permutation(len(codes))
+        self.codes = pa.array([codes[i] for i in order]); self.code_cdf = zipf_cdf(len(codes), 1.05)
+        self.price_per_kg = rng.lognormal(mean=4.0, sigma=1.5, size=len(codes))
+        # 1-4 варианта описания на код; описания повторяются, как у реальных декларантов
+        variants = rng.integers(1, 5, size=len(codes)); self.description_start = np.concatenate(([0], np.cumsum(variants)[:-1]))
+        self.description_variants = variants
+        descriptions = []
+        for n in variants:
+            noun = PRODUCT_NOUNS[rng.integers(len(PRODUCT_NOUNS))]; qualifier = PRODUCT_QUALIFIERS[rng.integers(len(PRODUCT_QUALIFIERS))]
+            for v in range(n):
+                descriptions.append(f"{noun} {qualifier}" + (f", арт. {int(rng.integers(100, 99999))}" if v else ""))
+        self.descriptions = pa.array(descriptions)
+
+    def _build_companies(self, rng, count):
+        forms = rng.integers(len(COMPANY_FORMS), size=count); roots = rng.integers(len(COMPANY_ROOTS), size=(count, 2))
+        suffixes = rng.integers(len(COMPANY_SUFFIXES), size=count)
+        names = [f"{COMPANY_ROOTS[a]}{COMPANY_ROOTS[b]}{COMPANY_SUFFIXES[s]}" for (a, b), s in zip(roots, suffixes)]
+        canonical = [f"{COMPANY_FORMS[f]} {n}" for f, n in zip(forms, names)]
+        # У ~10% компаний в декларациях встречается второе написание - в кавычках
+        self.company_has_variant = rng.random(count) < 0.1
+        variant = [f'{COMPANY_FORMS[f]} "{n}"' for f, n in zip(forms, names)]
+        self.company_names = pa.array(canonical + variant)
+        self.company_codes = pa.array([f"{c:08d}" for c in rng.choice(np.arange(10000000, 45000000), size=count, replace=False)])
+        self.company_cdf = zipf_cdf(count, 1.0)
+
+    def generate_chunk(self, rows, rng):
+        code = sample(rng, self.code_cdf, rows); company = sample(rng, self.company_cdf, rows)
+        day = sample(rng, self.date_cdf, rows)
+        description = self.description_start[code] + rng.integers(0, self.description_variants[code])
+        name = company + len(self.company_has_variant) * (self.company_has_variant[company] & (rng.random(rows) < 0.2))
+        value = np.round(rng.lognormal(mean=10.0, sigma=2.0, size=rows), 2)
+        weight = np.round(value / self.price_per_kg[code] * rng.lognormal(0.0, 0.3, size=rows), 3)
+        table = pa.table({
+            'data_deklaracii': self.dates.take(pa.array(day)),
+            'napryamok': pa.array([d for d, _ in DIRECTIONS]).take(pa.array(sample(rng, self.direction_cdf, rows))),
+            'nazva_kompanii': self.company_names.take(pa.array(name)),
+            'kod_yedrpou': self.company_codes.take(pa.array(company, mask=rng.random(rows) < 0.01)),
+            'kraina_partner': pa.array(COUNTRIES).take(pa.array(sample(rng, self.country_cdf, rows))),
+            'kod_uktzed': self.codes.take(pa.array(code)),
+            'opis_tovaru': self.descriptions.take(pa.array(description)),
+            'mytna_vartist_hrn': numbers_as_strings(value, rng.random(rows) < 0.002),
+            'vaha_netto_kg': numbers_as_strings(weight, rng.random(rows) < 0.001),
+            'vyd_transportu': pa.array([t for t, _ in TRANSPORTS]).take(pa.array(sample(rng, self.transport_cdf, rows))),
+        })
+        # Загрузки идут по времени - внутри порции строки упорядочены по дате
+        return table.sort_by('data_deklaracii')
+
+def numbers_as_strings(values, empty_mask):
+    # Числа строками, как в продакшене; пустая строка там, где значение не заполнено
+    strings = pa.array(values).cast(pa.string())
+    return pc.if_else(pa.array(empty_mask), pa.scalar('', pa.string()), strings)
+
+def default_dimensions(rows):
+    # Число компаний и кодов растёт с объёмом, но насыщается, как в реальных данных
+    return min(max(rows // 300, 1000), 300000), min(max(rows // 100, 2000), 15000)
+
+def generate(target_path, rows, seed=0, chunk_rows=DEFAULT_CHUNK_ROWS, companies=None, codes=None, start=datetime.date(2021, 1, 1), end=datetime.date(2025, 12, 31), progress=None):
+    import pyarrow.parquet as pq
+    default_companies, default_codes = default_dimensions(rows)
+    catalog = SyntheticCatalog(seed, companies or default_companies, codes or default_codes, start, end)
+    os.makedirs(target_path, exist_ok=True)
+    for name in os.listdir(target_path):
+        if name.startswith('part-') and name.endswith('.parquet'): os.remove(os.path.join(target_path, name))
+    written = 0; chunk_index = 0
+    while written < rows:
+        size = min(chunk_rows, rows - written)
+        # Своя последовательность случайных чисел у каждой порции - результат не зависит от размера порций по справочникам
+        table = catalog.generate_chunk(size, np.random.default_rng([seed, chunk_index]))
+        pq.write_table(table, os.path.join(target_path, f"part-{chunk_index:05d}.parquet"), row_group_size=122880)
+        written += size; chunk_index += 1
+        if progress is not None: progress(written, rows)
+    return target_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Генерація синтетичної таблиці declarations у форматі Parquet")
+    parser.add_argument('target', help="каталог для part-*.parquet")
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS)
+    parser.add_argument('--companies', type=int, help="кількість компаній (за замовчуванням залежить від --rows)")
+    parser.add_argument('--codes', type=int, help="кількість кодів УКТЗЕД (за замовчуванням залежить від --rows)")
+    parser.add_argument('--start', type=datetime.date.fromisoformat, default=datetime.date(2021, 1, 1))
+    parser.add_argument('--end', type=datetime.date.fromisoformat, default=datetime.date(2025, 12, 31))
+    args = parser.parse_args()
+    generate(
+        args.target, args.rows, seed=args.seed, chunk_rows=args.chunk_rows, companies=args.companies, codes=args.codes,
+        start=args.start, end=args.end, progress=lambda done, total: print(f"{done:,} / {total:,}".replace(',', ' '), flush=True),
+    )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import os
+import sys
+
+# Модули приложения лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture(scope='session')
+def declarations_path(tmp_path_factory):
+    # Небольшая синтетическая копия таблицы declarations (см. synthetic_data.py): 2021-2025 годы
+    from synthetic_data import generate
+    return generate(str(tmp_path_factory.mktemp('declarations')), rows=20000, seed=7)
+
+@pytest.fixture(scope='session')
+def duckdb_backend(declarations_path):
+    from query_backend import DuckDBBackend
+    return DuckDBBackend(declarations_path)
+
+@pytest.fixture(scope='session')
+def typed_snapshot(duckdb_backend, tmp_path_factory):
+    # Типизированная копия (дата - DATE, суммы - DOUBLE), как declarations_typed; where - частичная загрузка
+    def snapshot(where="TRUE"):
+        target = tmp_path_factory.mktemp('typed')
+        duckdb_backend.query(f"""
+            COPY (SELECT * REPLACE (TRY_CAST(data_deklaracii AS DATE) AS data_deklaracii,
+                                    TRY_CAST(mytna_vartist_hrn AS DOUBLE) AS mytna_vartist_hrn,
+                                    TRY_CAST(vaha_netto_kg AS DOUBLE) AS vaha_netto_kg)
+                  FROM declarations WHERE {where}) TO '{target / "part-00000.parquet"}' (FORMAT PARQUET)
+        """)
+        return str(target)
+    return snapshot
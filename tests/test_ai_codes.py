@@ -0,0 +1,81 @@
+import pytest
+from ai_codes import CodeSuggestionService, DescriptionIndex, SuggestionCache, UnexpectedModelResponse, normalize_description
+
+ROWS = [
+    ('кабелі мідні ізольовані', '8544491000', 120),
+    ('кабелі мідні для зв’язку', '8544421000', 40),
+    ('кабелі пластмасові', '3917400000', 30),
+    ('кабелі сталеві троси', '7312108900', 25),
+    ('фільтри масляні для двигунів', '8421230000', 60),
+    ('фільтри повітряні для двигунів', '8421310000', 50),
+    ('чай зелений листовий', '0902100000', 15),
+]
+
+class StubModel:
+    def __init__(self, response='["8544"]'):
+        self.response = response; self.prompts = []
+
+    def generate(self, prompt):
+        self.prompts.append(prompt); return self.response
+
+@pytest.fixture
+def index():
+    return DescriptionIndex(ROWS, max_df_ratio=1.0)
+
+@pytest.fixture
+def cache(tmp_path):
+    return SuggestionCache(str(tmp_path / 'suggestions.json'))
+
+def test_single_word_query_goes_to_model(index, cache):
+    # Одно слово покрывает все описания с ним - это не повод обходить модель
+    model = StubModel()
+    suggestion = CodeSuggestionService(model, cache=cache, index=index).suggest('кабелі')
+    assert suggestion.source == 'model' and suggestion.codes == ['8544']
+    assert len(model.prompts) == 1
+
+def test_strong_local_match_skips_model_and_is_not_cached(index, cache):
+    model = StubModel()
+    service = CodeSuggestionService(model, cache=cache, index=index)
+    suggestion = service.suggest('Кабелі мідні ізольовані')
+    assert suggestion.source == 'local' and suggestion.codes == ['8544491000']
+    assert model.prompts == [] and cache.get('кабелі мідні ізольовані') is None
+
+def test_strong_match_requires_one_position(index):
+    service = CodeSuggestionService(StubModel(), index=index)
+    # Оба кандидата покрывают запрос полностью и относятся к позиции 8421
+    assert service.strong_codes(index.match('фільтри для двигунів')) == ['8421230000', '8421310000']
+    # Даже без требования нескольких слов кандидаты из разных позиций не считаются сильными
+    assert CodeSuggestionService(StubModel(), index=index, min_matched=1).strong_codes(index.match('кабелі')) == []
+
+def test_model_answer_is_cached(index, cache):
+    model = StubModel('["0902", "090210"]')
+    service = CodeSuggestionService(model, cache=cache, index=index)
+    assert service.suggest('чай').codes == ['0902', '090210']
+    again = service.suggest(' ЧАЙ ')
+    assert again.source == 'cache' and again.codes == ['0902', '090210'] and len(model.prompts) == 1
+
+def test_candidates_reported_before_model_call(index, cache):
+    seen = []
+    model = StubModel()
+    model.generate = lambda prompt: seen.append('model') or '["8544"]'
+    CodeSuggestionService(model, cache=cache, index=index).suggest('кабелі', on_candidates=lambda c: seen.append(len(c)))
+    assert seen[0] == 4 and seen[-1] == 'model'
+
+def test_unexpected_model_response(index, cache):
+    service = CodeSuggestionService(StubModel('{"codes": ["8544"]}'), cache=cache, index=index)
+    with pytest.raises(UnexpectedModelResponse):
+        service.suggest('чай')
+    assert cache.get('чай') is None
+
+def test_without_model_local_candidates_are_returned(index):
+    suggestion = CodeSuggestionService(None, index=index).suggest('кабелі')
+    assert suggestion.source == 'local' and len(suggestion.codes) == 4
+
+def test_cache_ttl_and_limit(tmp_path):
+    now = [1000.0]
+    cache = SuggestionCache(str(tmp_path / 'c.json'), ttl=60, max_entries=2, clock=lambda: now[0])
+    for text in ('a', 'b', 'c'): cache.put(text, ['01'], 'model')
+    assert len(cache) == 2 and cache.get('a') is None
+    now[0] += 61
+    assert cache.get('b') is None
+    assert normalize_description(' Кабелі,  мідні! ') == 'кабелі мідні'
@@ -0,0 +1,42 @@
+import pandas as pd
+import pytest
+
+from code_index import CodeIndex, code_index_query
+from query_builder import positions_query, code_validation_query
+
+@pytest.fixture(scope='module')
+def index(duckdb_backend):
+    return CodeIndex.from_frame(duckdb_backend.query(*code_index_query(duckdb_backend.dialect)))
+
+@pytest.fixture(scope='module')
+def top_descriptions(duckdb_backend):
+    # Самые частые описания по каждому префиксу и коду; при равенстве частот годится любое из них
+    df = duckdb_backend.query("SELECT kod_uktzed, opis_tovaru FROM declarations WHERE opis_tovaru IS NOT NULL AND kod_uktzed IS NOT NULL")
+    def top(key):
+        counts = df.groupby([key, df['opis_tovaru']]).size()
+        best = counts.groupby(level=0).transform('max')
+        return counts[counts == best].reset_index(level=1)['opis_tovaru'].groupby(level=0).agg(set).to_dict()
+    return lambda n: top(df['kod_uktzed'].str[:n].rename('node') if n else 'kod_uktzed')
+
+def test_positions_match_query(duckdb_backend, index, top_descriptions):
+    expected = duckdb_backend.query(*positions_query(['84', '85'], duckdb_backend.dialect))
+    positions = index.positions(['84', '85'])
+    assert positions['pos_code'].tolist() == expected['pos_code'].tolist()
+    tops = top_descriptions(4)
+    assert all(description in tops[code] for code, description in zip(positions['pos_code'], positions['pos_description']))
+    assert all(description in tops[code] for code, description in zip(expected['pos_code'], expected['pos_description']))
+
+def test_validate_matches_query(duckdb_backend, index, top_descriptions):
+    codes = ['8471', '85']
+    expected = duckdb_backend.query(*code_validation_query(codes, duckdb_backend.dialect))
+    validated = index.validate(codes)
+    columns = list(expected.columns)
+    assert list(validated.columns) == columns and len(validated) == len(expected) == 50
+    # Порядок при равном числе деклараций и состав последней ступени топ-50 не определены - сверяем строки выше неё
+    declarations = columns[2]; cutoff = expected[declarations].min()
+    assert validated[declarations].min() == cutoff
+    by_code = lambda df: df[df[declarations] > cutoff].set_index(columns[0]).sort_index()
+    expected_rows, rows = by_code(expected), by_code(validated)
+    pd.testing.assert_frame_equal(rows[columns[2:]], expected_rows[columns[2:]], check_dtype=False)
+    tops = top_descriptions(None)
+    assert all(description in tops[code] for code, description in rows[columns[1]].items())
@@ -0,0 +1,45 @@
+import pytest
+
+from company_index import CompanyIndex, company_index_query
+from query_builder import EMPTY_FILTERS, count_query
+
+# У БУДСВІТ и БУДКИЇВ есть декларации без кода ЄДРПОУ - они находятся только по названию
+TERMS = ['агро', '"ЗЕРНО', 'прат мед', 'будсвіт', 'прАТ будкиїв']
+
+@pytest.fixture(scope='module')
+def table(duckdb_backend):
+    return duckdb_backend.query("SELECT kod_yedrpou, nazva_kompanii FROM declarations")
+
+@pytest.fixture(scope='module')
+def index(duckdb_backend):
+    return CompanyIndex.from_frame(duckdb_backend.query(*company_index_query(duckdb_backend.dialect)))
+
+def like_rows(table, terms):
+    # Условие UPPER(nazva_kompanii) LIKE '%TERM%' из build_filter_conditions
+    names = table['nazva_kompanii'].fillna('').str.upper()
+    return names.apply(lambda name: any(term.upper() in name for term in terms))
+
+def count(backend, **filters):
+    return backend.query(*count_query({**EMPTY_FILTERS, **filters}, backend.dialect))['total_rows'].iloc[0]
+
+@pytest.mark.parametrize('terms', [[term] for term in TERMS] + [TERMS])
+def test_resolve_matches_like(duckdb_backend, table, index, terms):
+    codes, names = index.resolve(terms)
+    like = like_rows(table, terms)
+    resolved = table['kod_yedrpou'].isin(codes) | table['nazva_kompanii'].isin(names)
+    assert like.any()
+    # Компания с кодом ЄДРПОУ попадает целиком, со всеми вариантами названия; без кода - по точному названию
+    assert not (like & ~resolved).any()
+    assert set(table.loc[resolved & ~like, 'kod_yedrpou']) <= set(table.loc[like, 'kod_yedrpou'].dropna())
+    no_code = table['kod_yedrpou'].isna()
+    assert bool(names) == (like & no_code).any()
+    assert (resolved[no_code] == like[no_code]).all()
+    # Условие фильтра по разрешённому набору даёт те же строки
+    assert count(duckdb_backend, company_match={'codes': codes, 'names': names}) == resolved.sum()
+    assert count(duckdb_backend, companies=terms) == like.sum()
+
+def test_variant_spelling_resolves_whole_company(table, index):
+    # '"ЗЕРНО' встречается только в варианте названия с кавычками - компания находится по любому из вариантов
+    codes, _ = index.resolve(['"ЗЕРНО'])
+    company_rows = table[table['kod_yedrpou'].isin(codes)]
+    assert (~company_rows['nazva_kompanii'].str.contains('"')).any()
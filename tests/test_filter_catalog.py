@@ -0,0 +1,54 @@
+import json
+import os
+from datetime import date
+import pytest
+from filter_catalog import FilterCatalog, refresh_catalog
+from query_backend import DuckDBBackend, DuckDBDialect
+
+def failing_run(query, params=None):
+    raise RuntimeError("backend unavailable")
+
+def stale_catalog(path):
+    catalog = FilterCatalog()
+    catalog.counts['years'] = {2024: 10}; catalog.watermark = date(2024, 5, 31)
+    catalog.built_at = 0.0; catalog.full_built_at = 0.0
+    catalog.save(path)
+    return catalog
+
+def test_failed_incremental_refresh_keeps_stale_file(tmp_path):
+    path = str(tmp_path / 'catalog.json'); stale_catalog(path)
+    with open(path, encoding='utf-8') as f: before = json.load(f)
+    with pytest.raises(RuntimeError):
+        refresh_catalog(path, failing_run, DuckDBDialect(typed=True), max_age=60, full_rebuild_age=10 ** 9, now=3600.0)
+    with open(path, encoding='utf-8') as f: assert json.load(f) == before
+
+def test_failed_cold_build_writes_nothing(tmp_path):
+    path = str(tmp_path / 'catalog.json')
+    with pytest.raises(RuntimeError):
+        refresh_catalog(path, failing_run, DuckDBDialect(), now=3600.0)
+    assert not os.path.exists(path)
+
+def test_fresh_catalog_is_served_without_queries(tmp_path):
+    path = str(tmp_path / 'catalog.json'); stale_catalog(path)
+    catalog = refresh_catalog(path, failing_run, DuckDBDialect(), max_age=60, now=30.0)
+    assert catalog.options()['years'] == [2024]
+
+def test_incremental_refresh_matches_full_rebuild(tmp_path, typed_snapshot):
+    # Первая загрузка обрывается посреди дня: половина деклараций за 2024-06-14 приходит позже
+    partial = DuckDBBackend(typed_snapshot("data_deklaracii < '2024-06-14' OR (data_deklaracii = '2024-06-14' AND hash(nazva_kompanii, opis_tovaru) % 2 = 0)"), typed=True)
+    full = DuckDBBackend(typed_snapshot(), typed=True)
+    path = str(tmp_path / 'catalog.json')
+    first = refresh_catalog(path, partial.query, partial.dialect, max_age=60, now=0.0)
+    assert first.watermark == date(2024, 6, 14)
+    updated = refresh_catalog(path, full.query, full.dialect, max_age=60, full_rebuild_age=10 ** 9, now=120.0)
+    rebuilt = refresh_catalog(str(tmp_path / 'rebuilt.json'), full.query, full.dialect, now=120.0)
+    assert updated.full_built_at == 0.0 and rebuilt.full_built_at == 120.0
+    assert updated.counts == rebuilt.counts and updated.watermark == rebuilt.watermark
+    assert updated.counts != first.counts
+
+def test_untyped_table_is_always_rebuilt(tmp_path, duckdb_backend):
+    path = str(tmp_path / 'catalog.json')
+    refresh_catalog(path, duckdb_backend.query, duckdb_backend.dialect, max_age=60, now=0.0)
+    sql = []
+    refresh_catalog(path, lambda query, params=None: sql.append(params) or duckdb_backend.query(query, params), duckdb_backend.dialect, max_age=60, now=120.0)
+    assert sql == [[]]
@@ -0,0 +1,88 @@
+from datetime import date
+import pandas as pd
+import pytest
+from query_backend import BigQueryDialect
+from query_builder import (
+    DISPLAY_COLUMNS, EMPTY_FILTERS, code_validation_query, company_count_query, company_query, count_query,
+    month_ranges, positions_query, search_query,
+)
+
+def test_month_ranges_merge_adjacent_months():
+    assert month_ranges([2024], [3, 1, 2]) == [(date(2024, 1, 1), date(2024, 4, 1))]
+    assert month_ranges([2024], [1, 3]) == [(date(2024, 1, 1), date(2024, 2, 1)), (date(2024, 3, 1), date(2024, 4, 1))]
+
+def test_month_ranges_merge_december_into_january():
+    assert month_ranges([2023, 2024], [12, 1]) == [
+        (date(2023, 1, 1), date(2023, 2, 1)), (date(2023, 12, 1), date(2024, 2, 1)), (date(2024, 12, 1), date(2025, 1, 1)),
+    ]
+
+def test_month_ranges_whole_years():
+    assert month_ranges(['2023', '2024'], []) == [(date(2023, 1, 1), date(2025, 1, 1))]
+
+def count(backend, **filters):
+    return int(backend.query(*count_query({**EMPTY_FILTERS, **filters}, backend.dialect))['total_rows'].iloc[0])
+
+def test_months_only_filter_keeps_years_missing_from_catalog(duckdb_backend):
+    # Каталог отстал: 2025 год в нём ещё нет, а январские и декабрьские строки 2025 года есть в таблице
+    expected = int(duckdb_backend.query(
+        "SELECT COUNT(*) AS n FROM declarations WHERE EXTRACT(MONTH FROM TRY_CAST(data_deklaracii AS DATE)) IN (1, 12)"
+    )['n'].iloc[0])
+    assert count(duckdb_backend, months=[1, 12], available_years=[2021, 2022, 2023, 2024]) == expected
+    assert count(duckdb_backend, months=[1, 12], available_years=[2021, 2022, 2023, 2024, 2025]) == expected
+    assert count(duckdb_backend, months=[1, 12], years=[2021, 2022, 2023, 2024]) < expected
+
+# --- ЗАПРОСЫ ЧЕРЕЗ DUCKDB И ДИАЛЕКТ BIGQUERY ---
+
+FILTERS = {**EMPTY_FILTERS, 'group_codes': ['84', '85'], 'years': [2023, 2024], 'months': [1, 12], 'weight_from': 1}
+
+@pytest.fixture(scope='module')
+def table(duckdb_backend):
+    df = duckdb_backend.query("SELECT * FROM declarations")
+    df['decl_date'] = pd.to_datetime(df['data_deklaracii'], errors='coerce')
+    df['weight'] = pd.to_numeric(df['vaha_netto_kg'], errors='coerce')
+    return df
+
+def expected_rows(table):
+    return table[
+        table['kod_uktzed'].str[:2].isin(['84', '85']).fillna(False) & table['decl_date'].dt.year.isin([2023, 2024])
+        & table['decl_date'].dt.month.isin([1, 12]) & (table['weight'] >= 1)
+    ]
+
+def test_search_and_count(duckdb_backend, table):
+    rows = duckdb_backend.query(*search_query(FILTERS, duckdb_backend.dialect))
+    total = duckdb_backend.query(*count_query(FILTERS, duckdb_backend.dialect))['total_rows'].iloc[0]
+    assert list(rows.columns) == DISPLAY_COLUMNS
+    assert len(rows) == total == len(expected_rows(table)) > 0
+
+def test_company_queries(duckdb_backend, table):
+    companies = duckdb_backend.query(*company_query(FILTERS, duckdb_backend.dialect, 'total_value'))
+    total = duckdb_backend.query(*company_count_query(FILTERS, duckdb_backend.dialect))['total_rows'].iloc[0]
+    expected = expected_rows(table)
+    assert len(companies) == total == expected['kod_yedrpou'].fillna('~' + expected['nazva_kompanii'].fillna('')).nunique()
+    assert companies['declarations'].sum() == len(expected)
+    assert companies['total_value'].is_monotonic_decreasing
+
+def test_positions_and_validation(duckdb_backend, table):
+    positions = duckdb_backend.query(*positions_query(['84'], duckdb_backend.dialect))
+    codes = table['kod_uktzed'].dropna()
+    assert set(positions['pos_code']) == set(codes[codes.str.startswith('84') & (codes.str.len() >= 4)].str[:4])
+    validated = duckdb_backend.query(*code_validation_query(['8471', '85'], duckdb_backend.dialect))
+    found = validated['Код УКТЗЕД в базі']
+    assert len(found) and found.str.startswith(('8471', '85')).all()
+    # Топ-50 кодов по числу деклараций - счётчики совпадают с подсчётом по таблице
+    counts = codes[codes.str.startswith(('8471', '85'))].value_counts()
+    assert dict(zip(found, validated['Кількість декларацій'])) == {code: counts[code] for code in found}
+    assert validated['Кількість декларацій'].iloc[0] == counts.max()
+
+def test_bigquery_dialect_sql():
+    untyped = BigQueryDialect('p.d.declarations'); typed = BigQueryDialect('p.d.declarations_typed', typed=True)
+    sql, params = search_query({**EMPTY_FILTERS, 'countries': ['CN'], 'group_codes': ['84'], 'years': [2024], 'weight_from': 5}, untyped)
+    assert "FROM `p.d.declarations`" in sql
+    assert "kraina_partner IN UNNEST(@countries)" in sql and "STARTS_WITH(kod_uktzed, @group0)" in sql
+    assert "SAFE_CAST(data_deklaracii AS DATE) >= @date_from0" in sql and "SAFE_CAST(vaha_netto_kg AS FLOAT64) >= @weight_from" in sql
+    assert {p.name for p in params} == {'countries', 'group0', 'date_from0', 'date_to0', 'weight_from'}
+    typed_sql, _ = search_query({**EMPTY_FILTERS, 'years': [2024], 'weight_from': 5}, typed)
+    assert "SAFE_CAST" not in typed_sql and "data_deklaracii >= @date_from0" in typed_sql and "vaha_netto_kg >= @weight_from" in typed_sql
+    company_sql, _ = company_query({**EMPTY_FILTERS, 'years': [2024]}, typed)
+    assert "SAFE_CAST" not in company_sql and "ARRAY_AGG(nazva_kompanii IGNORE NULLS ORDER BY decl_date DESC LIMIT 1)" in company_sql
+    assert "SAFE_CAST(mytna_vartist_hrn AS FLOAT64)" in code_validation_query(['84'], untyped)[0]
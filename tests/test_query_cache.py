@@ -0,0 +1,29 @@
+import pandas as pd
+from query_backend import QueryParam
+from query_cache import QueryResultCache, cache_key
+
+def backend_frame():
+    return pd.DataFrame({'kod_uktzed': pd.array(['8544', None], dtype='string'), 'total_value': [1.5, None], 'total_rows': [2, 3]})
+
+def test_miss_and_hit_return_same_dtypes():
+    cache = QueryResultCache(); key = cache_key("SELECT 1")
+    miss = cache.put(key, backend_frame()); hit = cache.get(key)
+    assert all(isinstance(dtype, pd.ArrowDtype) for dtype in miss.dtypes)
+    assert miss.dtypes.tolist() == hit.dtypes.tolist()
+    pd.testing.assert_frame_equal(miss, hit)
+
+def test_uncached_results_keep_the_same_form():
+    cache = QueryResultCache(max_bytes=1)
+    df = cache.put(cache_key("SELECT 1"), backend_frame())
+    assert all(isinstance(dtype, pd.ArrowDtype) for dtype in df.dtypes) and cache.stats()['entries'] == 0
+
+def test_key_normalizes_whitespace_and_param_order():
+    params = [QueryParam('b', 'STRING', 'x'), QueryParam('a', 'STRING', ['1', '2'])]
+    assert cache_key("SELECT  *\n FROM t WHERE x = 'a  b'", params) == cache_key("SELECT * FROM t WHERE x = 'a  b'", params[::-1])
+    assert cache_key("SELECT 'a  b'") != cache_key("SELECT 'a b'")
+
+def test_version_change_invalidates():
+    cache = QueryResultCache(version_check_interval=0); version = [1]
+    cache.sync_version(lambda: version[0]); cache.put(cache_key("SELECT 1"), backend_frame())
+    version[0] = 2; cache.sync_version(lambda: version[0])
+    assert cache.get(cache_key("SELECT 1")) is None and cache.stats()['invalidations'] == 1
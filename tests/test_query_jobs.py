@@ -0,0 +1,138 @@
+import threading
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from query_backend import BigQueryBackend, DuckDBBackend
+from query_jobs import JobCancelled, JobHandle, QueryExecutor, checked
+
+class FakeBackend:
+    # Запрос "выполняется", пока его не отменят или не отпустят release
+    def __init__(self):
+        self.started = threading.Event(); self.release = threading.Event(); self.cancelled = []
+
+    def query(self, sql, params=None, stats=None, handle=None):
+        if handle is not None:
+            handle.check(); handle.on_cancel(lambda: (self.cancelled.append(sql), self.release.set()))
+        self.started.set()
+        if not self.release.wait(5): raise TimeoutError(sql)
+        if sql in self.cancelled: raise RuntimeError(f"{sql} interrupted")
+        return sql
+
+class FakeBigQueryJob:
+    def __init__(self):
+        self.job_id = 'job-1'; self.cancelled = False; self._done = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True; self._done.set()
+
+    def result(self, **kwargs):
+        self._done.wait(5)
+        if self.cancelled: raise RuntimeError("Job was cancelled")
+
+class FakeBigQueryClient:
+    def __init__(self):
+        self.jobs = []
+
+    def query(self, sql, job_config=None):
+        self.jobs.append(FakeBigQueryJob()); return self.jobs[-1]
+
+@pytest.fixture
+def executor():
+    executor = QueryExecutor(max_workers=4)
+    yield executor
+    executor.shutdown()
+
+def test_new_job_supersedes_group(executor):
+    backend = FakeBackend()
+    first = executor.submit('s1', 'search', lambda handle: backend.query('first', handle=handle))
+    assert backend.started.wait(5)
+    other = executor.submit('s1', 'prefetch', lambda handle: 'other')
+    second = executor.submit('s1', 'search', lambda handle: 'second')
+    with pytest.raises(JobCancelled):
+        first.result(5)
+    assert backend.cancelled == ['first']
+    assert second.result(5) == 'second' and other.result(5) == 'other'
+
+def test_supersede_false_keeps_companion_job(executor):
+    count = executor.submit('s1', 'search', lambda handle: 'count')
+    page = executor.submit('s1', 'search', lambda handle: 'page', supersede=False)
+    assert (count.result(5), page.result(5)) == ('count', 'page')
+
+def test_sessions_are_independent(executor):
+    backend = FakeBackend()
+    job = executor.submit('s1', 'search', lambda handle: backend.query('s1', handle=handle))
+    assert backend.started.wait(5)
+    assert executor.cancel('s2') == 0 and not job.cancelled
+    assert [j.group for j in executor.in_flight('s1')] == ['search']
+    backend.release.set()
+    assert job.result(5) == 's1' and executor.in_flight('s1') == []
+
+def test_cancel_before_start_never_runs():
+    executor = QueryExecutor(max_workers=1); ran = []
+    try:
+        blocker = threading.Event()
+        executor.submit('s', 'busy', lambda handle: blocker.wait(5))
+        queued = executor.submit('s', 'queued', lambda handle: ran.append(1))
+        assert queued.cancel()
+        blocker.set()
+        with pytest.raises(JobCancelled):
+            queued.result(5)
+        assert ran == []
+    finally:
+        executor.shutdown()
+
+def test_handle_cancel_callbacks():
+    handle = JobHandle('g'); calls = []
+    handle.on_cancel(lambda: calls.append('registered'))
+    assert handle.cancel() and not handle.cancel()
+    handle.on_cancel(lambda: calls.append('late'))
+    assert calls == ['registered', 'late']
+    with pytest.raises(JobCancelled):
+        handle.check()
+
+def test_shared_job_runs_once_and_restarts_after_failure(executor):
+    calls = []
+    def build(handle):
+        calls.append(1); time.sleep(0.05); return 42
+    first = executor.shared('code_index', build); second = executor.shared('code_index', build)
+    assert first is second and first.result(5) == 42 and len(calls) == 1
+    executor.release('code_index')
+    assert executor.shared('code_index', build).result(5) == 42 and len(calls) == 2
+    def fail(handle): raise RuntimeError("boom")
+    failed = executor.shared('rollup', fail)
+    with pytest.raises(RuntimeError):
+        failed.result(5)
+    assert executor.shared('rollup', lambda handle: 'ok').result(5) == 'ok'
+
+def test_checked_stops_between_batches():
+    handle = JobHandle('export'); read = []
+    def batches():
+        for i in range(5): read.append(i); yield i
+    stream = checked(batches(), handle)
+    assert next(stream) == 0
+    handle.cancel()
+    with pytest.raises(JobCancelled):
+        next(stream)
+    assert read == [0, 1]
+
+def test_bigquery_job_cancelled(executor):
+    backend = BigQueryBackend(FakeBigQueryClient(), 'project.dataset.table')
+    backend.job_config = lambda params=None: None
+    job = executor.submit('s', 'search', lambda handle: backend.query('SELECT 1', handle=handle))
+    deadline = time.monotonic() + 5
+    while not backend.client.jobs and time.monotonic() < deadline: time.sleep(0.01)
+    executor.cancel('s')
+    with pytest.raises(JobCancelled):
+        job.result(5)
+    assert backend.client.jobs[0].cancelled
+
+def test_duckdb_query_interrupted(executor, tmp_path):
+    pq.write_table(pa.table({'kod_uktzed': ['8544']}), str(tmp_path / 'part.parquet'))
+    backend = DuckDBBackend(str(tmp_path))
+    job = executor.submit('s', 'search', lambda handle: backend.query("SELECT COUNT(*) FROM range(1000000000000)", handle=handle))
+    time.sleep(0.2); started = time.monotonic()
+    executor.cancel('s')
+    with pytest.raises(JobCancelled):
+        job.result(5)
+    assert time.monotonic() - started < 2
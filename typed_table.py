@@ -0,0 +1,98 @@
+# ===============================================
+# typed_table.py - Типизированная копия таблицы declarations
+# В исходной таблице дата и числа хранятся строками, из-за чего каждый запрос
+# делает SAFE_CAST по всем строкам и не может отсечь партиции. Здесь создаётся
+# копия с DATE/FLOAT64, партиционированная по месяцу декларации и
+# кластеризованная по коду УКТЗЕД / стране, и загрузчик, поддерживающий её в актуальном состоянии.
+#
+# Запуск:
+#   python typed_table.py                  - инкрементальная синхронизация BigQuery
+#   python typed_table.py --full           - пересоздать таблицу целиком
+#   python typed_table.py --local SRC DST  - типизированный Parquet-снимок для DuckDB
+# ===============================================
+
+import argparse
+import os
+
+PROJECT_ID = "ua-customs-analytics"
+SOURCE_TABLE_ID = f"{PROJECT_ID}.ua_customs_data.declarations"
+TYPED_TABLE_ID = f"{PROJECT_ID}.ua_customs_data.declarations_typed"
+CLUSTER_COLUMNS = ('kod_uktzed', 'kraina_partner', 'napryamok')
+# Сколько последних дней перезаливается при инкрементальной синхронизации (дни могут догружаться)
+DEFAULT_LOOKBACK_DAYS = 7
+
+def typed_select(source):
+    return f"""
+    SELECT * REPLACE (
+        SAFE_CAST(data_deklaracii AS DATE) AS data_deklaracii,
+        SAFE_CAST(mytna_vartist_hrn AS FLOAT64) AS mytna_vartist_hrn,
+        SAFE_CAST(vaha_netto_kg AS FLOAT64) AS vaha_netto_kg
+    ) FROM `{source}`"""
+
+def create_table_sql(source=SOURCE_TABLE_ID, target=TYPED_TABLE_ID):
+    return f"""
+    CREATE OR REPLACE TABLE `{target}`
+    PARTITION BY DATE_TRUNC(data_deklaracii, MONTH)
+    CLUSTER BY {', '.join(CLUSTER_COLUMNS)}
+    AS {typed_select(source)}
+    """
+
+def sync_table_sql(source=SOURCE_TABLE_ID, target=TYPED_TABLE_ID):
+    # Перезаливаются строки начиная с (последняя дата в копии - @lookback_days); фильтр по колонке
+    # партиционирования затрагивает только последние партиции, без полного сканирования копии
+    return f"""
+    DECLARE since DATE DEFAULT (SELECT DATE_SUB(MAX(data_deklaracii), INTERVAL @lookback_days DAY) FROM `{target}`);
+    BEGIN TRANSACTION;
+    DELETE FROM `{target}` WHERE data_deklaracii >= since;
+    INSERT INTO `{target}` {typed_select(source)} WHERE SAFE_CAST(data_deklaracii AS DATE) >= since;
+    COMMIT TRANSACTION;
+    """
+
+def sync_bigquery(client, full=False, lookback_days=DEFAULT_LOOKBACK_DAYS, source=SOURCE_TABLE_ID, target=TYPED_TABLE_ID):
+    from google.api_core.exceptions import NotFound
+    from google.cloud.bigquery import QueryJobConfig, ScalarQueryParameter
+    if not full:
+        try: client.get_table(target)
+        except NotFound: full = True
+    if full:
+        client.query(create_table_sql(source, target)).result()
+        return 'full'
+    job_config = QueryJobConfig(query_parameters=[ScalarQueryParameter("lookback_days", "INT64", lookback_days)])
+    client.query(sync_table_sql(source, target), job_config=job_config).result()
+    return 'incremental'
+
+def materialize_parquet(source_path, target_path, row_group_size=122880):
+    # Локальный аналог: типизированный Parquet, отсортированный по дате и коду УКТЗЕД.
+    # Статистики min/max по группам строк дают DuckDB то же отсечение, что и партиции в BigQuery.
+    import duckdb
+    source = os.path.join(source_path, '*.parquet') if os.path.isdir(source_path) else source_path
+    os.makedirs(target_path, exist_ok=True)
+    target_file = os.path.join(target_path, 'declarations.parquet')
+    con = duckdb.connect(database=':memory:')
+    con.execute(f"""
+    COPY (
+        SELECT * REPLACE (
+            TRY_CAST(data_deklaracii AS DATE) AS data_deklaracii,
+            TRY_CAST(mytna_vartist_hrn AS DOUBLE) AS mytna_vartist_hrn,
+            TRY_CAST(vaha_netto_kg AS DOUBLE) AS vaha_netto_kg
+        ) FROM read_parquet('{source}')
+        ORDER BY data_deklaracii, kod_uktzed
+    ) TO '{target_file}' (FORMAT PARQUET, ROW_GROUP_SIZE {int(row_group_size)})
+    """)
+    con.close()
+    return target_file
+
+def main():
+    parser = argparse.ArgumentParser(description="Синхронізація типізованої копії таблиці declarations")
+    parser.add_argument('--full', action='store_true', help="перестворити таблицю повністю")
+    parser.add_argument('--lookback-days', type=int, default=DEFAULT_LOOKBACK_DAYS)
+    parser.add_argument('--local', nargs=2, metavar=('SRC', 'DST'), help="створити типізований Parquet-знімок для DuckDB")
+    args = parser.parse_args()
+    if args.local:
+        print(materialize_parquet(*args.local)); return
+    from google.cloud import bigquery
+    mode = sync_bigquery(bigquery.Client(project=PROJECT_ID), full=args.full, lookback_days=args.lookback_days)
+    print(f"{TYPED_TABLE_ID}: {mode}")
+
+if __name__ == '__main__':
+    main()